@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter, defaultdict
+from aiohttp import web
+from fake_telegram import create_fake_bot_api, make_update
+
+
+CITIES = ["Москва", "Санкт-Петербург", "Казань", "Новосибирск", "Екатеринбург", "Сочи", "Мурманск", "Владивосток"]
+PRODUCTS = ["банан", "яблоко", "гречка", "овсянка", "куриная грудка", "творог", "хлеб", "шоколад", "рис", "молоко"]
+WORKOUTS = ["бег", "ходьба", "велосипед", "плавание"]
+STUB_ENV = {"BOT_TOKEN": "1:benchmark", "YANDEX_CLOUD_CAT_ID": "benchmark", "YANDEX_KEY_ID": "benchmark",
+            "YANDEX_API_KEY": "benchmark", "OPEN_WEATHER_API_KEY": "benchmark", "RATE_LIMITS": "",
+            "API_RATE_LIMITS": "", "METRICS_PORT": "0"}
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app()
+created = time.perf_counter()
+import benchmark
+print(json.dumps({"import_seconds": imported - started, "create_app_seconds": created - imported,
+                  "rss": benchmark.get_rss(), "matplotlib_loaded": "matplotlib" in sys.modules}))
+"""
+
+SHARDED_STORAGE_SCRIPT = """
+import asyncio, json, sys
+import main
+main.create_app()
+if sys.argv[1] == "create":
+    main.users[1] = main.UserRecord(70, 175, 30, 45, "Москва", "м")
+else:
+    main.get_user(1).logged_water += 250
+main.user_storage.save_user(1)
+asyncio.run(main.user_storage.flush())
+row = main.user_storage.db.execute("SELECT record FROM user_records WHERE user_id = 1").fetchone()
+print(json.dumps(None if row is None else main.UserRecord.from_bytes(row[0]).logged_water))
+"""
+
+
+def create_fake_openweather_api(latency=0.0):
+    calls = Counter()
+
+    async def handle_geocoding(request):
+        calls["geocoding"] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        seed = zlib.crc32(request.query.get("q", "").casefold().encode())
+        return web.json_response([{"lat": 40 + seed % 2000 / 100, "lon": 30 + seed % 9000 / 100}])
+
+    async def handle_weather(request):
+        calls["weather"] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        lat = float(request.query.get("lat", 0))
+        return web.json_response({"main": {"temp": round(45 - lat, 1)}, "timezone": 10800})
+
+    app = web.Application()
+    app["calls"] = calls
+    app.router.add_get("/geo/1.0/direct", handle_geocoding)
+    app.router.add_get("/data/2.5/weather", handle_weather)
+    return app
+
+
+def create_fake_yandex_gpt_api(latency=0.0):
+    calls = Counter()
+
+    async def handle_completion(request):
+        calls["completion"] += 1
+        payload = await request.json()
+        prompt = payload["messages"][0]["text"]
+        products = re.findall(r'^(\d+)\. "(.*)"$', prompt, re.MULTILINE)
+        if products:
+            text = "".join(f"{index}. {50 + zlib.crc32(name.encode()) % 400}\n" for index, name in products)
+        else:
+            text = f"{50 + zlib.crc32(prompt.encode()) % 400} ккал. "
+        text += "Это примерная оценка."
+
+        if not payload["completionOptions"].get("stream"):
+            if latency:
+                await asyncio.sleep(latency)
+            return web.json_response({"result": {"alternatives": [{"message": {"role": "assistant", "text": text},
+                                                                   "status": "ALTERNATIVE_STATUS_FINAL"}]}})
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+        pieces = re.findall(r"\S+\s*", text)
+        for count in range(1, len(pieces) + 1):
+            if latency:
+                await asyncio.sleep(latency / len(pieces))
+            status = "ALTERNATIVE_STATUS_FINAL" if count == len(pieces) else "ALTERNATIVE_STATUS_PARTIAL"
+            chunk = {"result": {"alternatives": [{"message": {"role": "assistant", "text": "".join(pieces[:count])},
+                                                  "status": status}]}}
+            try:
+                await response.write(json.dumps(chunk, ensure_ascii=False).encode() + b"\n")
+            except ConnectionResetError:
+                calls["cancelled"] += 1
+                break
+        return response
+
+    app = web.Application()
+    app["calls"] = calls
+    app.router.add_post("/foundationModels/v1/completion", handle_completion)
+    return app
+
+
+async def start_app(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def get_rss():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def user_script(user_id, rounds, graphs_every):
+    texts = ["/start", "/set_profile", str(60 + user_id % 40), str(160 + user_id % 30), str(20 + user_id % 40),
+             str(user_id % 90), CITIES[user_id % len(CITIES)], "мж"[user_id % 2], "Рассчитывать автоматически"]
+    for round_index in range(rounds):
+        product = PRODUCTS[(user_id + round_index) % len(PRODUCTS)]
+        texts += ["/log_water 250", f"/log_food {product}", "150",
+                  f"/log_workout {WORKOUTS[(user_id + round_index) % len(WORKOUTS)]} 30", "/check_progress"]
+        if graphs_every and (user_id + round_index) % graphs_every == 0:
+            texts.append("/progress_graphs")
+    return texts
+
+
+async def run_benchmark(args):
+    telegram_app = create_fake_bot_api(args.telegram_latency)
+    weather_app = create_fake_openweather_api(args.weather_latency)
+    gpt_app = create_fake_yandex_gpt_api(args.gpt_latency)
+    runners = []
+    urls = []
+    for app in (telegram_app, weather_app, gpt_app):
+        runner, url = await start_app(app)
+        runners.append(runner)
+        urls.append(url)
+
+    workdir = tempfile.TemporaryDirectory()
+    os.environ.update({
+        "TELEGRAM_API_URL": urls[0],
+        "OPEN_WEATHER_API_URL": urls[1],
+        "YANDEX_GPT_API_URL": urls[2],
+        "STORAGE": args.storage,
+        "DB_PATH": os.path.join(workdir.name, "bot.db"),
+        "EVENT_LOG_PATH": os.path.join(workdir.name, "events.bin")
+    })
+    for name, value in STUB_ENV.items():
+        os.environ.setdefault(name, value)
+    os.environ.setdefault("NUTRITION_INDEX_PATH", os.path.join(workdir.name, "nutrition_index"))
+
+    started = time.perf_counter()
+    main = importlib.import_module("main")
+    import_time = time.perf_counter() - started
+    main.create_app()
+    logging.getLogger().setLevel(args.log_level)
+    await main.dispatcher.emit_startup(bot=main.bot, dispatcher=main.dispatcher)
+    baseline_rss = get_rss()
+
+    update_ids = itertools.count(1)
+    latencies = defaultdict(list)
+    errors = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_id):
+        command = None
+        for text in user_script(user_id, args.rounds, args.graphs_every):
+            if text.startswith("/"):
+                command = text.split()[0][1:]
+            update = main.Update.model_validate(make_update(next(update_ids), user_id, text),
+                                                context={"bot": main.bot})
+            async with semaphore:
+                update_started = time.perf_counter()
+                try:
+                    await main.dispatcher.feed_update(main.bot, update)
+                except Exception as error:
+                    errors[f"{command}: {type(error).__name__}"] += 1
+                latencies[command].append(time.perf_counter() - update_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(user_id) for user_id in range(1, args.users + 1)))
+    elapsed = time.perf_counter() - started
+    peak_rss = get_rss()
+
+    await main.dispatcher.emit_shutdown(bot=main.bot, dispatcher=main.dispatcher)
+    await main.bot.session.close()
+    for runner in runners:
+        await runner.cleanup()
+    workdir.cleanup()
+
+    total = sum(len(values) for values in latencies.values())
+    commands = {}
+    for command, values in sorted(latencies.items()):
+        values.sort()
+        commands[command] = {"count": len(values), "p50": percentile(values, 0.5),
+                             "p95": percentile(values, 0.95), "p99": percentile(values, 0.99)}
+    return {
+        "users": args.users,
+        "updates": total,
+        "seconds": elapsed,
+        "updates_per_second": total / elapsed,
+        "import_seconds": import_time,
+        "baseline_rss": baseline_rss,
+        "peak_rss": peak_rss,
+        "rss_per_user": (peak_rss - baseline_rss) / args.users,
+        "commands": commands,
+        "errors": dict(errors),
+        "api_calls": {**telegram_app["calls"], **weather_app["calls"], **gpt_app["calls"]}
+    }
+
+
+def measure_startup(runs):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {**STUB_ENV, **os.environ, "STORAGE": "sqlite", "DB_PATH": os.path.join(workdir, "bot.db"),
+               "EVENT_LOG_PATH": os.path.join(workdir, "events.bin"), "PYTHONPATH": os.path.dirname(__file__)}
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, cwd=workdir,
+                                    capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output.splitlines()[-1]))
+    return min(results, key=lambda result: result["import_seconds"] + result["create_app_seconds"])
+
+
+def check_startup(args):
+    result = measure_startup(args.startup_runs)
+    startup_seconds = result["import_seconds"] + result["create_app_seconds"]
+    rss_mb = result["rss"] / 1024 ** 2
+    print(f"Startup: import {result['import_seconds']:.2f}s + create_app {result['create_app_seconds']:.2f}s, "
+          f"RSS {rss_mb:.1f} MB, matplotlib loaded: {result['matplotlib_loaded']}")
+    failures = []
+    if startup_seconds > args.startup_budget:
+        failures.append(f"startup took {startup_seconds:.2f}s, budget is {args.startup_budget:.2f}s")
+    if rss_mb > args.rss_budget:
+        failures.append(f"RSS is {rss_mb:.1f} MB, budget is {args.rss_budget:.1f} MB")
+    if result["matplotlib_loaded"]:
+        failures.append("matplotlib is imported outside the render workers")
+    for failure in failures:
+        print(f"Over budget: {failure}")
+    return not failures
+
+
+def check_sharded_storage():
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {**STUB_ENV, **os.environ, "STORAGE": "sqlite", "DB_PATH": os.path.join(workdir, "bot.db"),
+               "EVENT_LOG_PATH": os.path.join(workdir, "events.bin"), "PYTHONPATH": os.path.dirname(__file__)}
+        results = []
+        for phase, workers in (("create", "1"), ("update", "2")):
+            output = subprocess.run([sys.executable, "-c", SHARDED_STORAGE_SCRIPT, phase],
+                                    env={**env, "WORKERS": workers}, cwd=workdir,
+                                    capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output.splitlines()[-1]))
+    print(f"Sharded storage: stored water after create {results[0]}, after a sharded update {results[1]}")
+    if results != [0, 250]:
+        print("Sharded storage: a lazily loaded user was not written back")
+        return False
+    return True
+
+
+def print_report(result):
+    print(f"{result['updates']} updates from {result['users']} users in {result['seconds']:.2f}s: "
+          f"{result['updates_per_second']:.0f} updates/s")
+    print(f"{'command':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for command, stats in result["commands"].items():
+        print(f"{command:<18}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}"
+              f"{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+    print(f"Import: {result['import_seconds']:.2f}s, RSS: {result['baseline_rss'] / 1024 ** 2:.1f} MB -> "
+          f"{result['peak_rss'] / 1024 ** 2:.1f} MB, {result['rss_per_user'] / 1024:.1f} KB per user")
+    print(f"Stub API calls: {result['api_calls']}")
+    if result["errors"]:
+        print(f"Errors: {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the bot handlers with simulated users against local stub APIs")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=3, help="Logging rounds per user after profile setup")
+    parser.add_argument("--concurrency", type=int, default=200, help="Updates processed at the same time")
+    parser.add_argument("--graphs-every", type=int, default=0,
+                        help="Request /progress_graphs in every N-th round (0 disables chart rendering)")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Bot API latency in seconds")
+    parser.add_argument("--weather-latency", type=float, default=0.1, help="OpenWeather latency in seconds")
+    parser.add_argument("--gpt-latency", type=float, default=0.5, help="YandexGPT latency in seconds")
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--check-startup", action="store_true",
+                        help="Only measure import time and RSS of a fresh process and compare them to the budgets")
+    parser.add_argument("--startup-runs", type=int, default=3)
+    parser.add_argument("--startup-budget", type=float, default=6.0, help="Seconds to import main and create the app")
+    parser.add_argument("--rss-budget", type=float, default=176.0, help="MB after the app is created")
+    parser.add_argument("--check-sharded-storage", action="store_true",
+                        help="Only check that a user loaded lazily by a shard survives a flush")
+    args = parser.parse_args()
+
+    if args.check_sharded_storage:
+        sys.exit(0 if check_sharded_storage() else 1)
+
+    if args.check_startup:
+        sys.exit(0 if check_startup(args) else 1)
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import io
+import numpy as np
+from matplotlib.figure import Figure
+
+
+def render_weekly_png(labels, water, calories_in, calories_burned):
+    fig = Figure(figsize=(10, 5))
+    axes = fig.subplots(1, 2)
+    positions = np.arange(len(labels))
+    axes[0].bar(positions, water, color="blue")
+    axes[0].set_title("Вода по дням")
+    axes[0].set_ylabel("мл")
+
+    axes[1].bar(positions - 0.2, calories_in, width=0.4, color="orange", label="Потреблено")
+    axes[1].bar(positions + 0.2, calories_burned, width=0.4, color="red", label="Сожжено")
+    axes[1].set_title("Калории по дням")
+    axes[1].set_ylabel("ккал")
+    axes[1].legend()
+
+    for ax in axes:
+        ax.set_xticks(positions, labels)
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def render_progress_png(logged_water, water_goal, logged_calories, burned_calories, calorie_balance, calorie_goal):
+    fig = Figure(figsize=(10, 5))
+    axes = fig.subplots(1, 2)
+    axes[0].bar(["Выпито", "Цель"], [logged_water, water_goal], color=["blue", "gray"])
+    axes[0].set_title("Прогресс по воде")
+    axes[0].set_ylabel("мл")
+
+    axes[1].bar(["Потреблено", "Сожжено", "Баланс", "Цель"],
+                [logged_calories, burned_calories, calorie_balance, calorie_goal],
+                color=["orange", "red", "green", "blue"])
+    axes[1].set_title("Прогресс по калориям")
+    axes[1].set_ylabel("ккал")
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def render_report_png(labels, water, calories_in, calories_burned, water_goal, calorie_goal, window):
+    fig = Figure(figsize=(12, 8))
+    axes = fig.subplots(2, 1, sharex=True)
+    positions = np.arange(len(labels))
+    axes[0].bar(positions, water, color="blue", alpha=0.6, label="Выпито")
+    axes[0].axhline(water_goal, color="gray", linestyle="--", label="Норма")
+    axes[0].set_title("Вода по дням")
+    axes[0].set_ylabel("мл")
+
+    axes[1].bar(positions - 0.2, calories_in, width=0.4, color="orange", label="Потреблено")
+    axes[1].bar(positions + 0.2, calories_burned, width=0.4, color="red", label="Сожжено")
+    axes[1].axhline(calorie_goal, color="gray", linestyle="--", label="Цель")
+    axes[1].set_title("Калории по дням")
+    axes[1].set_ylabel("ккал")
+
+    if window and len(labels) >= window:
+        kernel = np.ones(window) / window
+        trend_positions = positions[window - 1:]
+        axes[0].plot(trend_positions, np.convolve(water, kernel, "valid"), color="navy",
+                     label=f"Среднее за {window} дн.")
+        axes[1].plot(trend_positions, np.convolve(np.subtract(calories_in, calories_burned), kernel, "valid"),
+                     color="green", label=f"Баланс, среднее за {window} дн.")
+
+    step = max(len(labels) // 15, 1)
+    axes[1].set_xticks(positions[::step], labels[::step], rotation=45)
+    for ax in axes:
+        ax.legend(loc="upper left")
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+weekly_sheet_templates = {}
+
+
+def create_weekly_sheet(grid, days):
+    fig = Figure(figsize=(4 * grid[1], 3 * grid[0]))
+    positions = np.arange(days)
+    cells = []
+    for ax in fig.subplots(*grid).flat:
+        bars = ax.bar(positions, np.zeros(days), color="blue")
+        calories_ax = ax.twinx()
+        line, = calories_ax.plot(positions, np.zeros(days), color="orange", marker="o")
+        ax.set_xticks(positions, ["00.00"] * days, fontsize=7)
+        ax.set_title("ID0", fontsize=9)
+        ax.tick_params(axis="y", labelsize=7, labelcolor="blue")
+        calories_ax.tick_params(axis="y", labelsize=7, labelcolor="orange")
+        cells.append((ax, calories_ax, bars, line))
+    fig.suptitle("Вода, мл (столбцы) и потребленные калории, ккал (линия) за неделю")
+    fig.tight_layout(rect=(0, 0, 1, 0.96))
+    return fig, cells
+
+
+def render_weekly_sheets(grid, user_ids, labels, totals):
+    days = totals.shape[2]
+    template = weekly_sheet_templates.get((grid, days))
+    if template is None:
+        template = weekly_sheet_templates[(grid, days)] = create_weekly_sheet(grid, days)
+    fig, cells = template
+
+    sheets = []
+    for start in range(0, len(user_ids), len(cells)):
+        for row, (ax, calories_ax, bars, line) in enumerate(cells, start=start):
+            visible = row < len(user_ids)
+            ax.set_visible(visible)
+            calories_ax.set_visible(visible)
+            if not visible:
+                continue
+            water, calories_in, calories_burned = totals[row]
+            for bar, height in zip(bars, water):
+                bar.set_height(height)
+            line.set_ydata(calories_in)
+            ax.set_ylim(0, max(water.max(), 1) * 1.1)
+            calories_ax.set_ylim(0, max(calories_in.max(), 1) * 1.1)
+            ax.set_xticklabels(labels[row])
+            ax.set_title(f"ID{user_ids[row]}, сожжено {calories_burned.sum():.0f} ккал")
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png")
+        sheets.append(buffer.getvalue())
+    return sheets
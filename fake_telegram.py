@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from aiohttp import web, ClientSession
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text
+        }
+    }
+
+
+def create_fake_bot_api(latency=0.0):
+    message_ids = itertools.count(1)
+    calls = Counter()
+
+    async def handle_method(request):
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        calls[method] += 1
+        if latency:
+            await asyncio.sleep(latency)
+
+        if method == "getme":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bot",
+                                                             "username": "fake_bot"}})
+        if method == "sendmediagroup":
+            media = json.loads(data.get("media", "[]"))
+            return web.json_response({"ok": True, "result": [
+                {"message_id": next(message_ids), "date": int(time.time()),
+                 "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                 "document": {"file_id": f"document{index}", "file_unique_id": f"document{index}"}}
+                for index, _ in enumerate(media)]})
+        if method in ("sendmessage", "sendphoto", "senddocument", "editmessagetext"):
+            message = {
+                "message_id": int(data.get("message_id") or next(message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"}
+            }
+            if method == "sendphoto":
+                photo = data.get("photo")
+                file_id = photo if isinstance(photo, str) else f"photo{message['message_id']}"
+                message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1000, "height": 500}]
+            elif method == "senddocument":
+                file_id = f"document{message['message_id']}"
+                message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+            else:
+                message["text"] = data.get("text", "")
+            return web.json_response({"ok": True, "result": message})
+        return web.json_response({"ok": True, "result": True})
+
+    app = web.Application(client_max_size=32 * 1024 ** 2)
+    app["calls"] = calls
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    return app
+
+
+async def send_updates(webhook_url, secret, updates, concurrency):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    statuses = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with ClientSession() as session:
+        async def send(update):
+            async with semaphore:
+                async with session.post(webhook_url, json=update, headers=headers) as response:
+                    statuses[response.status] += 1
+
+        await asyncio.gather(*(send(update) for update in updates))
+    return statuses
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram: serves the Bot API and posts updates to a webhook")
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Bot API latency in seconds")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--text", action="append", help="Message sent by every user (repeatable)")
+    args = parser.parse_args()
+
+    app = create_fake_bot_api(args.latency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.api_host, args.api_port).start()
+    print(f"Fake Bot API on http://{args.api_host}:{args.api_port}, start the bot with "
+          f"TELEGRAM_API_URL=http://{args.api_host}:{args.api_port} BOT_MODE=webhook. Press Enter to send updates.")
+    await asyncio.get_running_loop().run_in_executor(None, input)
+
+    update_ids = itertools.count(1)
+    updates = [make_update(next(update_ids), user_id, text)
+               for text in args.text or ["/start"] for user_id in range(1, args.users + 1)]
+    started = time.perf_counter()
+    statuses = await send_updates(args.webhook_url, args.secret, updates, args.concurrency)
+    elapsed = time.perf_counter() - started
+    print(f"Sent {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s), "
+          f"webhook statuses: {dict(statuses)}")
+
+    await asyncio.sleep(1)
+    print(f"Bot API calls: {dict(app['calls'])}")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,28 +1,157 @@
 import os
 import logging
 import sys
+import signal
+import queue
+import multiprocessing
 import datetime
+import time
+import heapq
+import random
 import re
-import requests
+import hmac
+import importlib
+import json
 import asyncio
-from aiogram import Bot, Dispatcher, Router
-from aiogram.types import Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, FSInputFile
+import sqlite3
+import struct
+import aiohttp
+from aiohttp import web
+import numpy as np
+from array import array
+from bisect import bisect_left
+from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from aiogram import Bot, Dispatcher, Router, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import (Update, Message, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, BufferedInputFile,
+                           InputMediaDocument)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.filters import Command, StateFilter
-import matplotlib.pyplot as plt
+from nutrition import NutritionIndex, normalize_product_name
 
 
 YANDEX_CLOUD_CAT_ID = os.getenv("YANDEX_CLOUD_CAT_ID")
 YANDEX_KEY_ID = os.getenv("YANDEX_KEY_ID")
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")
+YANDEX_GPT_API_URL = os.getenv("YANDEX_GPT_API_URL", "https://llm.api.cloud.yandex.net")
 
 OPEN_WEATHER_API_KEY = os.getenv("OPEN_WEATHER_API_KEY")
+OPEN_WEATHER_API_URL = os.getenv("OPEN_WEATHER_API_URL", "https://api.openweathermap.org")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-
-if not all([YANDEX_CLOUD_CAT_ID, YANDEX_KEY_ID, YANDEX_API_KEY, OPEN_WEATHER_API_KEY, BOT_TOKEN]):
-    raise ValueError("Check environment variables")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 32))
+WORKERS = int(os.getenv("WORKERS", 1))
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+
+RATE_LIMITS = os.getenv("RATE_LIMITS", "default=30/60,log_food=10/60,progress_graphs=5/60,weekly_graphs=5/60,"
+                                       "history=10/60,set_profile=5/60,report=5/60")
+API_RATE_LIMITS = os.getenv("API_RATE_LIMITS", "yandex_gpt=10/1,open_weather=60/60")
+API_RATE_MAX_WAIT = float(os.getenv("API_RATE_MAX_WAIT", 5))
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", 0.5))
+
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", 10000))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", 10000))
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", 600))
+WEATHER_REFRESH_SHARE = float(os.getenv("WEATHER_REFRESH_SHARE", 0.5))
+
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+FOOD_CACHE_SIZE = int(os.getenv("FOOD_CACHE_SIZE", 50000))
+NUTRITION_INDEX_PATH = os.getenv("NUTRITION_INDEX_PATH", "nutrition_index")
+NUTRITION_MATCH_THRESHOLD = float(os.getenv("NUTRITION_MATCH_THRESHOLD", 0.6))
+LLM_BATCH_WINDOW = float(os.getenv("LLM_BATCH_WINDOW", 0.1))
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", 20))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 4))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", 16))
+STORAGE = os.getenv("STORAGE", "sqlite")
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 1))
+EVENT_LOG_PATH = os.getenv("EVENT_LOG_PATH", "events.bin")
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_QUEUE_LIMIT = int(os.getenv("RENDER_QUEUE_LIMIT", 16))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 10000))
+REPORT_PERIODS = (7, 30, 90)
+WEEKLY_SHEET_GRID = (4, 4)
+WEEKLY_SHEETS_PER_MESSAGE = 10
+REMINDER_INTERVAL = float(os.getenv("REMINDER_INTERVAL", 10800))
+REMINDER_DAY_START = int(os.getenv("REMINDER_DAY_START", 9))
+REMINDER_DAY_END = int(os.getenv("REMINDER_DAY_END", 21))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 25))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", 25))
+
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip().isdigit()}
+
+
+PROFILE_FIELDS = ("weight", "height", "age", "activity", "city", "gender", "calorie_goal", "utc_offset")
+DAILY_COUNTERS = ("logged_water", "logged_calories", "burned_calories", "additional_water_goal")
+DAILY_FIELDS = ("day",) + DAILY_COUNTERS
+
+
+EVENT_WATER, EVENT_FOOD, EVENT_WORKOUT = range(3)
+EVENT_DTYPE = np.dtype([("ts", "<i8"), ("user_id", "<i8"), ("kind", "u1"), ("value", "<f4")])
+
+GENDERS = ("м", "ж")
+USER_RECORD_VERSION = 1
+USER_RECORD_FORMATS = {1: struct.Struct("<IIIIBiiIqdqq")}
+
+
+class UserRecord:
+    __slots__ = PROFILE_FIELDS + DAILY_FIELDS + ("base_water_goal",)
+
+    def __init__(self, weight, height, age, activity, city, gender, calorie_goal=None, utc_offset=0, day=0,
+                 logged_water=0, logged_calories=0, burned_calories=0, additional_water_goal=0):
+        self.weight = weight
+        self.height = height
+        self.age = age
+        self.activity = activity
+        self.city = city
+        self.gender = gender
+        self.calorie_goal = calorie_goal
+        self.utc_offset = utc_offset or 0
+        self.day = day or 0
+        self.logged_water = logged_water or 0
+        self.logged_calories = logged_calories or 0
+        self.burned_calories = burned_calories or 0
+        self.additional_water_goal = additional_water_goal or 0
+        compute_goals(self)
+
+    def to_bytes(self):
+        return bytes([USER_RECORD_VERSION]) + USER_RECORD_FORMATS[USER_RECORD_VERSION].pack(
+            self.weight, self.height, self.age, self.activity, GENDERS.index(self.gender), self.calorie_goal,
+            self.utc_offset, self.day, self.logged_water, self.logged_calories, self.burned_calories,
+            self.additional_water_goal) + self.city.encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        record_format = USER_RECORD_FORMATS.get(data[0])
+        if record_format is None:
+            raise ValueError(f"Unsupported user record version: {data[0]}")
+        (weight, height, age, activity, gender, calorie_goal, utc_offset, day, logged_water, logged_calories,
+         burned_calories, additional_water_goal) = record_format.unpack_from(data, 1)
+        return cls(weight, height, age, activity, bytes(data[1 + record_format.size:]).decode(), GENDERS[gender],
+                   calorie_goal, utc_offset, day, logged_water, logged_calories, burned_calories,
+                   additional_water_goal)
 
 
 class UserProfile(StatesGroup):
@@ -35,8 +164,189 @@ class UserProfile(StatesGroup):
     calorie_goal = State()
 
 
-def generate_text(prompt, iam_token, folder_id, model_name="yandexgpt-lite", temperature=0.6, max_tokens=2000):
-    url = f"https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+http_session = None
+
+
+async def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT,
+                                           limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                                           keepalive_timeout=30,
+                                           ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+    return http_session
+
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+
+async def http_request(method, url, read=None, **kwargs):
+    session = await get_http_session()
+    for attempt in range(HTTP_RETRIES + 1):
+        delay = HTTP_BACKOFF * 2 ** attempt
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if read is not None and response.status == 200:
+                    return response.status, await read(response)
+                if response.status not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                    return response.status, await response.text()
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == HTTP_RETRIES:
+                raise
+        await asyncio.sleep(delay)
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=""):
+    text = ",".join([f'{key}="{value}"' for key, value in labels] + ([extra] if extra else []))
+    return f"{{{text}}}" if text else ""
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = []
+
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, labels, value=1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def gauge(self, collect):
+        self.gauges.append(collect)
+
+    def render(self):
+        families = {}
+
+        def add(name, kind, sample):
+            families.setdefault(name, [f"# TYPE {name} {kind}"]).append(sample)
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            total = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                total += count
+                le = f'le="{bound}"'
+                add(name, "histogram", f"{name}_bucket{format_labels(labels, le)} {total}")
+            add(name, "histogram", f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            add(name, "histogram", f"{name}_count{format_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            add(name, "counter", f"{name}{format_labels(labels)} {value}")
+        for collect in self.gauges:
+            for name, labels, value in collect():
+                add(name, "counter" if name.endswith("_total") else "gauge", f"{name}{format_labels(labels)} {value}")
+        return "\n".join(sample for samples in families.values() for sample in samples) + "\n"
+
+
+metrics = Metrics()
+
+
+def timed(dependency, limit=None):
+    labels = (("dependency", dependency),)
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if limit is not None:
+                await api_limiter.acquire(limit, API_RATE_MAX_WAIT)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as error:
+                metrics.inc("bot_dependency_errors_total", labels + (("error", type(error).__name__),))
+                raise
+            finally:
+                metrics.observe("bot_dependency_seconds", labels, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class RateLimited(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def parse_rate_limits(spec, scale=1):
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            name, limit = item.split("=")
+            count, period = limit.split("/")
+            limits[name.strip()] = (max(float(count) * scale, 1), float(period))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, limits, max_size=100000):
+        self.limits = limits
+        self.max_size = max_size
+        self.buckets = {}
+        self.allowed = dict.fromkeys(limits, 0)
+        self.throttled = dict.fromkeys(limits, 0)
+
+    def reserve(self, name, key, max_wait=0):
+        count, period = self.limits[name]
+        interval = period / count
+        now = time.monotonic()
+        ready_at = max(self.buckets.get((name, key), now), now)
+        wait = ready_at - now - period + interval
+        if wait > max_wait:
+            self.throttled[name] += 1
+            return wait
+        self.allowed[name] += 1
+        self.buckets[(name, key)] = ready_at + interval
+        if len(self.buckets) > self.max_size:
+            self.buckets = {bucket: value for bucket, value in self.buckets.items() if value > now}
+        return max(wait, 0)
+
+    async def acquire(self, name, max_wait):
+        if name not in self.limits:
+            return
+        wait = self.reserve(name, None, max_wait)
+        if wait > max_wait:
+            raise RateLimited(name, wait)
+        metrics.observe("bot_rate_limit_wait_seconds", (("limit", name),), wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        return {name: (self.allowed[name], self.throttled[name]) for name in self.limits}
+
+
+@timed("yandex_gpt", limit="yandex_gpt")
+async def generate_text(prompt, iam_token, folder_id, model_name="yandexgpt-lite", temperature=0.6, max_tokens=2000,
+                        stop=None):
+    url = f"{YANDEX_GPT_API_URL}/foundationModels/v1/completion"
     model_uri = f"gpt://{folder_id}/{model_name}"
 
     headers = {
@@ -47,7 +357,7 @@ def generate_text(prompt, iam_token, folder_id, model_name="yandexgpt-lite", tem
     payload = {
         "modelUri": model_uri,
         "completionOptions": {
-            "stream": False,
+            "stream": stop is not None,
             "temperature": temperature,
             "maxTokens": str(max_tokens)
         },
@@ -59,15 +369,31 @@ def generate_text(prompt, iam_token, folder_id, model_name="yandexgpt-lite", tem
         ]
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 200:
+    read = None if stop is None else lambda response: read_completion_stream(response, stop)
+    status, text = await http_request("POST", url, read=read, headers=headers, json=payload)
+    if status != 200:
+        raise Exception(f"Error: {status}, {text}")
+    if stop is not None:
+        return text
+    try:
+        result = json.loads(text)
+        return result["result"]["alternatives"][0]["message"]["text"]
+    except KeyError:
+        raise ValueError("Unexpected response format")
+
+
+async def read_completion_stream(response, stop):
+    text = ""
+    async for line in response.content:
+        if not line.strip():
+            continue
         try:
-            result = response.json()
-            return result["result"]["alternatives"][0]["message"]["text"]
+            text = json.loads(line)["result"]["alternatives"][0]["message"]["text"]
         except KeyError:
             raise ValueError("Unexpected response format")
-    else:
-        raise Exception(f"Error: {response.status_code}, {response.text}")
+        if stop(text):
+            break
+    return text
 
 
 def extract_average_number(text):
@@ -85,26 +411,54 @@ def extract_average_number(text):
     return None
 
 
-def get_geolocation(city, api_key):
-    url = f'http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=1&appid={api_key}'
-    response = requests.get(url)
-    if response.status_code == 401:
+def has_complete_number(text):
+    match = re.search(r'(\d+)(\s*[\-–—−]\s*(\d+)?)?', text)
+    if match is None or match.end() == len(text):
+        return False
+    if match.group(2) and not match.group(3):
+        return False
+    rest = text[match.end():]
+    return match.group(2) is not None or "\n" in rest or not rest.isspace()
+
+
+def has_complete_numbers(text, count):
+    return None not in extract_average_numbers(text[:text.rfind("\n") + 1], count)
+
+
+def extract_average_numbers(text, count):
+    results = [None] * count
+    for line in text.splitlines():
+        match = re.match(r'\s*(\d+)\s*[.):]\s*(.*)', line)
+        if match and 1 <= int(match.group(1)) <= count:
+            results[int(match.group(1)) - 1] = extract_average_number(match.group(2).rsplit(":", 1)[-1])
+    return results
+
+
+@timed("openweather_geocoding", limit="open_weather")
+async def get_geolocation(city, api_key):
+    url = f'{OPEN_WEATHER_API_URL}/geo/1.0/direct'
+    status, text = await http_request("GET", url, params={"q": city, "limit": 1, "appid": api_key})
+    if status == 401:
         return {"error": "Invalid API key"}
-    response.raise_for_status()
-    response_data = response.json()
+    if status != 200:
+        raise Exception(f"Error: {status}, {text}")
+    response_data = json.loads(text)
     if response_data:
         return {"lat": response_data[0]["lat"], "lon": response_data[0]["lon"]}
     return {"error": "City not found"}
 
 
-def get_current_temp(lat, lon, api_key):
-    url = f'https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric'
-    response = requests.get(url)
-    if response.status_code == 401:
+@timed("openweather_weather", limit="open_weather")
+async def get_current_weather(lat, lon, api_key):
+    url = f'{OPEN_WEATHER_API_URL}/data/2.5/weather'
+    status, text = await http_request("GET", url, params={"lat": lat, "lon": lon, "appid": api_key,
+                                                          "units": "metric"})
+    if status == 401:
         return {"error": "Invalid API key"}
-    response.raise_for_status()
-    data = response.json()
-    return data["main"]["temp"]
+    if status != 200:
+        raise Exception(f"Error: {status}, {text}")
+    data = json.loads(text)
+    return {"temp": data["main"]["temp"], "utc_offset": data.get("timezone", 0)}
 
 
 def get_declension(value, forms):
@@ -119,12 +473,612 @@ def get_declension(value, forms):
     return forms[2]
 
 
-bot = Bot(token=BOT_TOKEN)
-dispatcher = Dispatcher(storage=MemoryStorage())
-router = Router()
-dispatcher.include_router(router)
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        item = self.data.get(key)
+        return item is not None and (item[1] is None or item[1] > time.monotonic())
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at is None or expires_at > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.data[key] = (value, expires_at)
+        self.data.move_to_end(key)
+        evicted = []
+        while len(self.data) > self.maxsize:
+            evicted.append(self.data.popitem(last=False)[0])
+            self.evictions += 1
+        return evicted
+
+    def pop(self, key):
+        item = self.data.pop(key, None)
+        return None if item is None else item[0]
+
+    async def get_or_fetch(self, key, fetch):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, fetch))
+            self.pending[key] = future
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key, fetch):
+        try:
+            value = await fetch()
+            if value is not None and not (isinstance(value, dict) and "error" in value):
+                self.set(key, value)
+            return value
+        finally:
+            del self.pending[key]
+
+    def stats(self):
+        requests_total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / requests_total if requests_total else 0.0
+        }
+
+
+class FoodCalorieCache(TTLCache):
+    def __init__(self, maxsize, db_path):
+        super().__init__(maxsize)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS food_calories ("
+                        "name TEXT PRIMARY KEY, kcal INTEGER NOT NULL, updated_at REAL NOT NULL)")
+        rows = self.db.execute("SELECT name, kcal FROM food_calories ORDER BY updated_at DESC LIMIT ?",
+                               (maxsize,)).fetchall()
+        for name, kcal in reversed(rows):
+            self.data[name] = (kcal, None)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="food-cache")
+
+    def set(self, key, value):
+        evicted = super().set(key, value)
+        self.executor.submit(self._persist, key, value, evicted)
+        return evicted
+
+    def _persist(self, key, value, evicted):
+        try:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO food_calories (name, kcal, updated_at) VALUES (?, ?, ?)",
+                                (key, value, time.time()))
+                self.db.executemany("DELETE FROM food_calories WHERE name = ?", [(name,) for name in evicted])
+        except sqlite3.Error:
+            logger.exception(f'Failed to persist food calories for "{key}"')
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+
+class MemoryUserStorage:
+    def __init__(self):
+        self.users = {}
+        self.fsm = MemoryStorage()
+
+    def load_users(self):
+        return self.users
+
+    def load_user(self, user_id):
+        return None
+
+    def load_user_ids(self, shard, shards):
+        return [user_id for user_id in self.users if user_id % shards == shard]
+
+    def load_utc_offsets(self):
+        return {user_id: user.utc_offset for user_id, user in self.users.items()}
+
+    def save_user(self, user_id):
+        pass
+
+    def append_history(self, user_id, day, counters):
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteFSMStorage(BaseStorage):
+    def __init__(self, storage):
+        self.storage = storage
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def _get_record(self, key, create=False):
+        record = self.storage.load_state(key)
+        if record is None and create:
+            record = self.storage.states[key] = {"state": None, "data": {}}
+        return record
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        record = self._get_record(key, create=True)
+        record["state"] = state.state if isinstance(state, State) else state
+        self.storage.save_state(key)
+
+    async def get_state(self, key):
+        record = self._get_record(self.key_builder.build(key))
+        return record["state"] if record else None
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        record = self._get_record(key, create=True)
+        record["data"] = data.copy()
+        self.storage.save_state(key)
+
+    async def get_data(self, key):
+        record = self._get_record(self.key_builder.build(key))
+        return record["data"].copy() if record else {}
+
+    async def close(self):
+        pass
+
+
+class SQLiteUserStorage(MemoryUserStorage):
+    def __init__(self, db_path, flush_interval):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.states = {}
+        self.dirty_users = set()
+        self.dirty_states = set()
+        self.history = []
+        self.flush_task = None
+        self.fsm = SQLiteFSMStorage(self)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.reader = sqlite3.connect(db_path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS user_records (user_id INTEGER PRIMARY KEY, record BLOB NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS daily_history ("
+                            "user_id INTEGER, day INTEGER, logged_water NUMERIC, logged_calories NUMERIC, "
+                            "burned_calories NUMERIC, additional_water_goal INTEGER, "
+                            "PRIMARY KEY (user_id, day)) WITHOUT ROWID")
+            self.db.execute("CREATE TABLE IF NOT EXISTS fsm_states (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+
+    def load_users(self):
+        self.users.update((user_id, UserRecord.from_bytes(record))
+                          for user_id, record in self.db.execute("SELECT user_id, record FROM user_records"))
+        for key, state, data in self.db.execute("SELECT key, state, data FROM fsm_states"):
+            self.states[key] = {"state": state, "data": json.loads(data)}
+        return self.users
+
+    def load_user(self, user_id):
+        row = self.reader.execute("SELECT record FROM user_records WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        user = self.users[user_id] = UserRecord.from_bytes(row[0])
+        return user
+
+    def load_user_ids(self, shard, shards):
+        cursor = self.reader.execute("SELECT user_id FROM user_records WHERE user_id % ? = ?", (shards, shard))
+        return [row[0] for row in cursor]
+
+    def load_utc_offsets(self):
+        offsets = {user_id: UserRecord.from_bytes(record).utc_offset
+                   for user_id, record in self.reader.execute("SELECT user_id, record FROM user_records")}
+        offsets.update(super().load_utc_offsets())
+        return offsets
+
+    def load_state(self, key):
+        record = self.states.get(key, MISSING)
+        if record is MISSING:
+            row = self.reader.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,)).fetchone()
+            record = self.states[key] = None if row is None else {"state": row[0], "data": json.loads(row[1])}
+        return record
+
+    def save_user(self, user_id):
+        self.dirty_users.add(user_id)
+
+    def save_state(self, key):
+        self.dirty_states.add(key)
+
+    def append_history(self, user_id, day, counters):
+        self.history.append((user_id, day, *counters))
+
+    async def start(self):
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush storage")
+
+    async def flush(self):
+        if not self.dirty_users and not self.dirty_states and not self.history:
+            return
+        dirty_users, dirty_states, history = self.dirty_users, self.dirty_states, self.history
+        self.dirty_users = set()
+        self.dirty_states = set()
+        self.history = []
+        try:
+            await self._flush(dirty_users, dirty_states, history)
+        except BaseException:
+            self.dirty_users |= dirty_users
+            self.dirty_states |= dirty_states
+            self.history[:0] = history
+            raise
+
+    async def _flush(self, dirty_users, dirty_states, history):
+        records = [(user_id, self.users[user_id].to_bytes()) for user_id in dirty_users]
+        states, deleted_states = [], []
+        for key in dirty_states:
+            record = self.states.get(key)
+            if record is None or (record["state"] is None and not record["data"]):
+                self.states[key] = None
+                deleted_states.append((key,))
+            else:
+                states.append((key, record["state"], json.dumps(record["data"], ensure_ascii=False)))
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._write, records, states, deleted_states, history)
+
+    def _write(self, records, states, deleted_states, history):
+        history_columns = ", ".join(("user_id", "day") + DAILY_COUNTERS)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO user_records (user_id, record) VALUES (?, ?)", records)
+            self.db.executemany(f"INSERT OR REPLACE INTO daily_history ({history_columns}) "
+                                f"VALUES ({', '.join('?' * (len(DAILY_COUNTERS) + 2))})", history)
+            self.db.executemany("INSERT OR REPLACE INTO fsm_states VALUES (?, ?, ?)", states)
+            self.db.executemany("DELETE FROM fsm_states WHERE key = ?", deleted_states)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.flush()
+        self.executor.shutdown(wait=True)
+        self.db.close()
+        self.reader.close()
+
+
+class EventLog:
+    def __init__(self, path, flush_interval, shard=None, shards=1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.index = {}
+        self.pending = bytearray()
+        self.flush_task = None
+        self.write_future = None
+        self.sharded = shard is not None and shards > 1
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="event-log")
+
+        data = np.fromfile(path, dtype=np.uint8) if path and os.path.exists(path) else np.empty(0, np.uint8)
+        complete = len(data) - len(data) % EVENT_DTYPE.itemsize
+        loaded = data[:complete].view(EVENT_DTYPE)
+        if shard is not None and shards > 1:
+            loaded = loaded[loaded["user_id"] % shards == shard]
+        self.size = len(loaded)
+        self.events = np.empty(max(1024, 2 * self.size), dtype=EVENT_DTYPE)
+        self.events[:self.size] = loaded
+        if self.size:
+            order = np.argsort(loaded["user_id"], kind="stable")
+            user_ids, starts = np.unique(loaded["user_id"][order], return_index=True)
+            for user_id, positions in zip(user_ids.tolist(), np.split(order, starts[1:])):
+                self.index[user_id] = array("q", positions.astype(np.int64).tobytes())
+        self.file = open(path, "ab", buffering=0) if path else None
+        if self.file is not None and len(data) != complete:
+            self.file.truncate(complete)
+
+    def append(self, user_id, kind, value):
+        if self.size == len(self.events):
+            events = np.empty(2 * len(self.events), dtype=EVENT_DTYPE)
+            events[:self.size] = self.events[:self.size]
+            self.events = events
+        record = self.events[self.size:self.size + 1]
+        record[0] = (int(time.time()), user_id, kind, value)
+        self.index.setdefault(user_id, array("q")).append(self.size)
+        self.size += 1
+        if self.file is not None:
+            self.pending += record.tobytes()
+
+    def query(self, user_id, since):
+        positions = self.index.get(user_id)
+        if not positions:
+            return self.events[:0]
+        positions = np.frombuffer(positions, dtype=np.int64)
+        start = np.searchsorted(self.events["ts"][positions], since)
+        return self.events[positions[start:]]
+
+    def daily_totals(self, user_id, days, utc_offset):
+        today = (int(time.time()) + utc_offset) // 86400
+        first_day = today - days + 1
+        events = self.query(user_id, first_day * 86400 - utc_offset)
+        day_index = (events["ts"] + utc_offset) // 86400 - first_day
+        totals = np.bincount(events["kind"].astype(np.int64) * days + day_index,
+                             weights=events["value"], minlength=3 * days)
+        return first_day, totals.reshape(3, days)
+
+    async def load_all(self):
+        if not self.sharded or self.file is None:
+            return self.events[:self.size]
+        await self.flush()
+        data = await asyncio.get_running_loop().run_in_executor(self.executor, np.fromfile, self.path, np.uint8)
+        return data[:len(data) - len(data) % EVENT_DTYPE.itemsize].view(EVENT_DTYPE)
+
+    def bulk_daily_totals(self, user_ids, utc_offsets, days, events=None):
+        order = np.argsort(np.asarray(user_ids, dtype=np.int64))
+        user_ids = np.asarray(user_ids, dtype=np.int64)[order]
+        utc_offsets = np.asarray(utc_offsets, dtype=np.int64)[order]
+        first_days = (int(time.time()) + utc_offsets) // 86400 - days + 1
+        if not len(user_ids):
+            return user_ids, first_days, np.zeros((0, 3, days))
+
+        events = self.events[:self.size] if events is None else events
+        events = events[events["ts"] >= (first_days * 86400 - utc_offsets).min()]
+        rows = np.minimum(np.searchsorted(user_ids, events["user_id"]), len(user_ids) - 1)
+        known = user_ids[rows] == events["user_id"]
+        events, rows = events[known], rows[known]
+        day_index = (events["ts"] + utc_offsets[rows]) // 86400 - first_days[rows]
+        valid = (day_index >= 0) & (day_index < days)
+        totals = np.bincount((rows[valid] * 3 + events["kind"][valid]) * days + day_index[valid],
+                             weights=events["value"][valid], minlength=len(user_ids) * 3 * days)
+        return user_ids, first_days, totals.reshape(len(user_ids), 3, days)
+
+    async def start(self):
+        if self.file is not None:
+            self.flush_task = asyncio.create_task(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception("Failed to flush event log")
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending = memoryview(bytes(self.pending))
+        self.pending.clear()
+        written = [0]
+        self.write_future = asyncio.get_running_loop().run_in_executor(self.executor, self._write, pending, written)
+        try:
+            await self.write_future
+        except Exception:
+            self.pending[:0] = pending[written[0]:]
+            raise
+
+    def _write(self, pending, written):
+        while written[0] < len(pending):
+            count = self.file.write(pending[written[0]:])
+            if not count:
+                raise OSError(f"Wrote {written[0]} of {len(pending)} event log bytes")
+            written[0] += count
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        try:
+            if self.file is not None:
+                if self.write_future is not None:
+                    await asyncio.gather(self.write_future, return_exceptions=True)
+                await self.flush()
+        finally:
+            if self.file is not None:
+                self.file.close()
+            self.executor.shutdown(wait=True)
+
+
+def create_user_storage():
+    if STORAGE == "memory":
+        return MemoryUserStorage()
+    if STORAGE == "sqlite":
+        return SQLiteUserStorage(DB_PATH, DB_FLUSH_INTERVAL)
+    raise ValueError(f"Unknown storage: {STORAGE}")
+
+
+class CalorieBatcher:
+    def __init__(self, window, max_size, max_in_flight):
+        self.window = window
+        self.max_size = max_size
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.pending = {}
+        self.flush_handle = None
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def estimate(self, key, product_name):
+        item = self.pending.get(key)
+        if item is None:
+            item = self.pending[key] = (product_name, asyncio.get_running_loop().create_future())
+            if len(self.pending) >= self.max_size:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await asyncio.shield(item[1])
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = list(self.pending.values()), {}
+        if batch:
+            run_in_background(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        names = [product_name for product_name, _ in batch]
+        try:
+            if len(batch) == 1:
+                results = [await self.estimate_single(names[0])]
+            else:
+                results = await self.estimate_many(names)
+                failed = [index for index, result in enumerate(results) if result is None]
+                self.fallbacks += len(failed)
+                fallback_results = await asyncio.gather(*(self.estimate_single(names[index]) for index in failed))
+                for index, result in zip(failed, fallback_results):
+                    results[index] = result
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def estimate_single(self, product_name):
+        async with self.semaphore:
+            return await estimate_calories(product_name)
+
+    async def estimate_many(self, names):
+        self.batches += 1
+        self.batched_items += len(names)
+        products = "\n".join(f'{index}. "{name}"' for index, name in enumerate(names, start=1))
+        async with self.semaphore:
+            text = await generate_text(
+                'Сколько ккал на 100г в среднем содержится в каждом продукте из списка? '
+                'Если нет точного ответа, оцени примерно. Ответь строго по одной строке на продукт в том же '
+                'порядке в формате "номер. число" - без названий, пояснений и рассуждений. '
+                'Не пиши никаких других чисел в ответе.\n' + products,
+                YANDEX_API_KEY,
+                YANDEX_CLOUD_CAT_ID,
+                temperature=0,
+                max_tokens=LLM_MAX_TOKENS * len(names),
+                stop=lambda text: has_complete_numbers(text, len(names))
+            )
+        return extract_average_numbers(text, len(names))
+
+
+geo_cache = TTLCache(GEO_CACHE_SIZE)
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, ttl=WEATHER_CACHE_TTL)
+city_weather = {}
+weather_refresh_task = None
+background_tasks = set()
+metrics_runner = None
+event_loop_lag_task = None
+shard_index = None
+food_cache = None
+nutrition_index = NutritionIndex(NUTRITION_INDEX_PATH, NUTRITION_MATCH_THRESHOLD)
+calorie_batcher = CalorieBatcher(LLM_BATCH_WINDOW, LLM_BATCH_SIZE, LLM_MAX_IN_FLIGHT)
+chart_cache = TTLCache(CHART_CACHE_SIZE)
+chart_keys = {}
+api_limiter = RateLimiter(parse_rate_limits(API_RATE_LIMITS, 1 / WORKERS))
+
+
+async def estimate_calories(product_name):
+    return extract_average_number(await generate_text(
+        f'Сколько ккал на 100г в среднем содержится в продукте: "{product_name}". '
+        'Если нет точного ответа, оцени примерно. Отправь только значение числом - без пояснений и рассуждений. '
+        'Не пиши никаких других чисел в ответе.',
+        YANDEX_API_KEY,
+        YANDEX_CLOUD_CAT_ID,
+        temperature=0,
+        max_tokens=LLM_MAX_TOKENS,
+        stop=has_complete_number
+    ))
+
+
+async def get_city_geolocation(city):
+    key = " ".join(city.casefold().split())
+    return await geo_cache.get_or_fetch(key, lambda: get_geolocation(city, OPEN_WEATHER_API_KEY))
+
+
+async def get_city_weather(city):
+    geo = await get_city_geolocation(city)
+    if 'error' in geo:
+        return None
+    key = (round(geo["lat"], 2), round(geo["lon"], 2))
+    weather = await weather_cache.get_or_fetch(key, lambda: get_current_weather(geo["lat"], geo["lon"],
+                                                                                OPEN_WEATHER_API_KEY))
+    return None if 'error' in weather else weather
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+render_pool = None
+render_queue_depth = 0
+
+
+def render_chart(name, *args):
+    return getattr(importlib.import_module("charts"), name)(*args)
+
 
+async def render_in_pool(name, *args):
+    global render_pool, render_queue_depth
+    if render_queue_depth >= RENDER_QUEUE_LIMIT:
+        raise RenderQueueFull(f"{render_queue_depth} charts are already queued")
+    if render_pool is None:
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["__main__" if __name__ == "__main__" else __name__, "charts"])
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=context)
+    render_queue_depth += 1
+    try:
+        return await timed(name)(asyncio.get_running_loop().run_in_executor)(render_pool, render_chart, name, *args)
+    finally:
+        render_queue_depth -= 1
+
+
+def invalidate_chart(user_id):
+    chart_keys.pop(user_id, None)
+
+
+def close_render_pool():
+    if render_pool is not None:
+        render_pool.shutdown(wait=True, cancel_futures=True)
+
+
+user_storage = None
 users = {}
+event_log = None
+bot = None
+dispatcher = None
+router = Router()
+
+
+async def observe_telegram_request(make_request, bot, method):
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as error:
+        metrics.inc("bot_dependency_errors_total", (("dependency", "telegram"), ("error", type(error).__name__)))
+        raise
+    finally:
+        metrics.observe("bot_dependency_seconds", (("dependency", "telegram"), ("method", type(method).__name__)),
+                        time.perf_counter() - started)
+
 
 logging.basicConfig(
     level=logging.INFO,
@@ -138,95 +1092,401 @@ logging.getLogger("aiogram").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-async def reset_logs():
-    while True:
-        now = datetime.datetime.now()
-        reset_time = datetime.datetime.combine(now.date(), datetime.time(0, 0)) + datetime.timedelta(days=1)
-        sleep_seconds = (reset_time - now).total_seconds()
-        await asyncio.sleep(sleep_seconds)
+def local_day(user):
+    return (int(time.time()) + user.utc_offset) // 86400
 
-        for user_id in users:
-            users[user_id]["logged_water"] = 0
-            users[user_id]["logged_calories"] = 0
-            users[user_id]["burned_calories"] = 0
-            users[user_id]["additional_water_goal"] = 0
-            logger.info(f'ID{user_id} -- Reset stats')
 
+def calculate_calorie_goal(weight, height, age, gender):
+    if gender == "м":
+        return int(10 * weight + 6.25 * height - 5 * age + 5)
+    return int(10 * weight + 6.25 * height - 5 * age - 161)
 
-def plot_progress(user_id):
-    user = users[user_id]
-    weight = user["weight"]
-    activity = user["activity"]
-    city = user["city"]
 
-    logged_water = user.get("logged_water", 0)
+def compute_goals(user):
+    user.base_water_goal = user.weight * 30 + 500 * (user.activity // 30)
+    if user.calorie_goal is None:
+        user.calorie_goal = calculate_calorie_goal(user.weight, user.height, user.age, user.gender)
 
-    geo = get_geolocation(city, OPEN_WEATHER_API_KEY)
-    if 'error' in geo:
-        temp = 20
-    else:
-        temp = get_current_temp(geo["lat"], geo["lon"], OPEN_WEATHER_API_KEY) or 20
-
-    water_goal = (user.get("additional_water_goal", 0) +
-                  weight * 30 + (500 * (activity // 30)))
-    if temp > 25:
-        water_goal += 500
-    if temp > 30:
-        water_goal += 1000
-
-    fig, axes = plt.subplots(1, 2, figsize=(10, 5))
-    axes[0].bar(["Выпито", "Цель"], [logged_water, water_goal], color=["blue", "gray"])
-    axes[0].set_title("Прогресс по воде")
-    axes[0].set_ylabel("мл")
-
-    logged_calories = user.get("logged_calories", 0)
-    burned_calories = user.get("burned_calories", 0)
-
-    calorie_goal = user.get("calorie_goal", None)
-    if calorie_goal is None:
-        if user['gender'] == "м":
-            calorie_goal = int(10 * weight + 6.25 * user['height'] - 5 * user['age'] + 5)
+
+def temperature_water_bonus(temp):
+    return (500 if temp > 25 else 0) + (1000 if temp > 30 else 0)
+
+
+def get_water_goal(user, temp):
+    return user.base_water_goal + user.additional_water_goal + temperature_water_bonus(temp)
+
+
+def get_user(user_id):
+    user = users.get(user_id)
+    if user is None:
+        user = user_storage.load_user(user_id)
+        if user is None:
+            return None
+        users[user_id] = user
+        if user_id not in reminder_scheduler.due:
+            reminder_scheduler.schedule(user_id, user, random.random() * REMINDER_INTERVAL)
+    day = local_day(user)
+    if day > user.day:
+        if user.day:
+            counters = [getattr(user, field) for field in DAILY_COUNTERS]
+            if any(counters):
+                user_storage.append_history(user_id, user.day, counters)
+            for field in DAILY_COUNTERS:
+                setattr(user, field, 0)
+            invalidate_chart(user_id)
+        user.day = day
+        user_storage.save_user(user_id)
+    return user
+
+
+async def load_city_weather(city):
+    city = " ".join(city.casefold().split())
+    entry = city_weather.get(city)
+    if entry is None:
+        weather = await get_city_weather(city)
+        if weather is None:
+            return None
+        entry = city_weather.setdefault(city, dict(weather))
+    entry["used_at"] = time.monotonic()
+    return entry
+
+
+def get_cached_temp(user_id, user):
+    entry = city_weather.get(" ".join(user.city.casefold().split()))
+    if entry is None:
+        return None
+    entry["used_at"] = time.monotonic()
+    if user.utc_offset != entry["utc_offset"]:
+        user.utc_offset = entry["utc_offset"]
+        if user.day:
+            user.day = local_day(user)
+        user_storage.save_user(user_id)
+    return entry["temp"]
+
+
+async def get_user_temp(user_id, user):
+    temp = get_cached_temp(user_id, user)
+    if temp is None and await load_city_weather(user.city) is not None:
+        temp = get_cached_temp(user_id, user)
+    return temp
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
+    return task
+
+
+def finish_background_task(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
+
+
+async def refresh_city_weather():
+    count, period = api_limiter.limits.get("open_weather", (1, 0))
+    min_interval = period / count / WEATHER_REFRESH_SHARE if WEATHER_REFRESH_SHARE > 0 else 0
+    await asyncio.sleep(WEATHER_CACHE_TTL)
+    while True:
+        started = time.monotonic()
+        for city in [city for city, entry in city_weather.items() if started - entry["used_at"] > 86400]:
+            del city_weather[city]
+        cities = list(city_weather)
+        interval = max(WEATHER_CACHE_TTL / max(len(cities), 1), min_interval)
+        for city in cities:
+            await asyncio.sleep(interval)
+            try:
+                weather = await get_city_weather(city)
+            except RateLimited:
+                continue
+            except Exception as error:
+                logger.warning(f'Failed to refresh weather for "{city}": {error}')
+                continue
+            if weather is not None and city in city_weather:
+                city_weather[city].update(weather)
+        await asyncio.sleep(max(WEATHER_CACHE_TTL - (time.monotonic() - started), 0))
+
+
+async def start_weather_refresh():
+    global weather_refresh_task
+    weather_refresh_task = asyncio.create_task(refresh_city_weather())
+
+
+async def stop_weather_refresh():
+    if weather_refresh_task is not None:
+        weather_refresh_task.cancel()
+
+
+async def measure_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        metrics.observe("bot_event_loop_lag_seconds", (), max(loop.time() - started - EVENT_LOOP_LAG_INTERVAL, 0))
+
+
+def collect_runtime_metrics():
+    for name, cache in [("geo", geo_cache), ("weather", weather_cache), ("food", food_cache), ("chart", chart_cache)]:
+        stats = cache.stats()
+        labels = (("cache", name),)
+        yield "bot_cache_hits_total", labels, stats["hits"]
+        yield "bot_cache_misses_total", labels, stats["misses"]
+        yield "bot_cache_hit_ratio", labels, stats["hit_rate"]
+        yield "bot_cache_entries", labels, stats["size"]
+    yield "bot_nutrition_index_hits_total", (), nutrition_index.hits
+    yield "bot_nutrition_index_misses_total", (), nutrition_index.misses
+    for name, (allowed, throttled) in (rate_limit_middleware.limiter.stats() | api_limiter.stats()).items():
+        yield "bot_rate_limit_allowed_total", (("limit", name),), allowed
+        yield "bot_rate_limit_throttled_total", (("limit", name),), throttled
+    yield "bot_update_queue_size", (), update_queue.qsize()
+    yield "bot_render_queue_depth", (), render_queue_depth
+    yield "bot_background_tasks", (), len(background_tasks)
+    yield "bot_reminders_pending", (), len(reminder_scheduler.due)
+    for result in ("sent", "skipped", "failed"):
+        yield "bot_reminders_total", (("result", result),), getattr(reminder_scheduler, result)
+
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+
+async def start_metrics_server():
+    global metrics_runner, event_loop_lag_task
+    event_loop_lag_task = asyncio.create_task(measure_event_loop_lag())
+    if METRICS_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    port = METRICS_PORT if shard_index is None else METRICS_PORT + 1 + shard_index
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+    except OSError as error:
+        logger.error(f'Failed to serve metrics on {METRICS_HOST}:{port}: {error}')
+        await metrics_runner.cleanup()
+        metrics_runner = None
+        return
+    logger.info(f'Serving metrics on http://{METRICS_HOST}:{port}/metrics')
+
+
+async def stop_metrics_server():
+    if event_loop_lag_task is not None:
+        event_loop_lag_task.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+
+class ReminderScheduler:
+    def __init__(self, interval, day_start, day_end, batch_size, rate):
+        self.interval = interval
+        self.day_start = day_start * 3600
+        self.day_end = day_end * 3600
+        self.batch_size = batch_size
+        self.rate = rate
+        self.heap = []
+        self.due = {}
+        self.resume_at = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def next_time(self, user, delay):
+        due = time.time() + delay
+        seconds = (due + user.utc_offset) % 86400
+        if seconds < self.day_start:
+            due += self.day_start - seconds
+        elif seconds >= self.day_end:
+            due += 86400 - seconds + self.day_start
+        return due
+
+    def schedule(self, user_id, user, delay=None):
+        if not self.interval:
+            return
+        due = self.next_time(user, self.interval if delay is None else delay)
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+        if self.heap[0][1] == user_id:
+            self.wakeup.set()
+
+    async def start(self):
+        if not self.interval or (WORKERS > 1 and shard_index is None):
+            return
+        if WORKERS == 1:
+            for user_id, user in users.items():
+                self.due[user_id] = self.next_time(user, random.random() * self.interval)
         else:
-            calorie_goal = int(10 * weight + 6.25 * user['height'] - 5 * user['age'] - 161)
-    calorie_balance = logged_calories - burned_calories
+            now = time.time()
+            for user_id in user_storage.load_user_ids(shard_index, WORKERS):
+                self.due[user_id] = now + random.random() * self.interval
+        self.heap = [(due, user_id) for user_id, due in self.due.items()]
+        heapq.heapify(self.heap)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            delay = max(self.heap[0][0] if self.heap else now + 3600, self.resume_at) - now
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(delay, 3600))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = []
+            while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+                due, user_id = heapq.heappop(self.heap)
+                if self.due.get(user_id) == due:
+                    batch.append(user_id)
+            started = loop.time()
+            await asyncio.gather(*(self.remind(user_id, now) for user_id in batch))
+            await asyncio.sleep(max(len(batch) / self.rate - (loop.time() - started), 0))
+
+    async def remind(self, user_id, now):
+        user = get_user(user_id)
+        if user is None:
+            self.due.pop(user_id, None)
+            return
+        seconds = (now + user.utc_offset) % 86400
+        if not self.day_start <= seconds < self.day_end:
+            self.schedule(user_id, user, 0)
+            return
+        temp = get_cached_temp(user_id, user)
+        water_goal = get_water_goal(user, 20 if temp is None else temp)
+        expected = water_goal * min(max((seconds - self.day_start) / (self.day_end - self.day_start), 0), 1)
+        if user.logged_water >= expected:
+            self.skipped += 1
+            self.schedule(user_id, user)
+            return
+
+        try:
+            await bot.send_message(user_id, f"💧 Не забудьте про воду! Выпито {user.logged_water} мл из {water_goal} мл, "
+                                            f"осталось {water_goal - user.logged_water} мл.\n"
+                                            f"Записать: /log_water <количество мл>")
+        except TelegramRetryAfter as error:
+            self.resume_at = max(self.resume_at, time.time() + error.retry_after)
+            self.schedule(user_id, user, error.retry_after)
+            return
+        except TelegramForbiddenError:
+            self.due.pop(user_id, None)
+            return
+        except TelegramAPIError as error:
+            self.failed += 1
+            logger.warning(f'ID{user_id} -- Failed to send reminder: {error}')
+        else:
+            self.sent += 1
+        self.schedule(user_id, user)
+
+
+reminder_scheduler = ReminderScheduler(REMINDER_INTERVAL, REMINDER_DAY_START, REMINDER_DAY_END,
+                                       REMINDER_BATCH_SIZE, REMINDER_RATE / WORKERS)
+
+
+def get_progress_chart_inputs(user, temp):
+    return (user.logged_water, get_water_goal(user, temp), user.logged_calories, user.burned_calories,
+            user.logged_calories - user.burned_calories, user.calorie_goal)
 
-    axes[1].bar(["Потреблено", "Сожжено", "Баланс", "Цель"],
-                [logged_calories, burned_calories, calorie_balance, calorie_goal],
-                color=["orange", "red", "green", "blue"])
-    axes[1].set_title("Прогресс по калориям")
-    axes[1].set_ylabel("ккал")
 
-    if not os.path.isdir('graphs'):
-        os.mkdir('graphs')
+def start_progress_render(chart_inputs):
+    file_id = chart_cache.get(chart_inputs)
+    if file_id is not None:
+        return file_id, None
+    return None, asyncio.ensure_future(render_in_pool("render_progress_png", *chart_inputs))
 
-    plt.tight_layout()
-    file_path = f"graphs/progress_{user_id}.png"
-    plt.savefig(file_path)
-    plt.close()
-    return file_path
+
+class RateLimitMiddleware(BaseMiddleware):
+    def __init__(self, limits):
+        self.limiter = RateLimiter(limits)
+        self.notified = {}
+        self.cached_replies = 0
+        self.api_rejections = 0
+
+    async def __call__(self, handler, event, data):
+        user_id = event.from_user.id
+        command = event.text.split()[0][1:].split("@")[0] if event.text and event.text.startswith("/") else None
+        for name in (command, "default"):
+            if name in self.limiter.limits:
+                wait = self.limiter.reserve(name, user_id)
+                if wait > 0:
+                    logger.warning(f'ID{user_id} -- Throttled: {event.text}')
+                    await self.reply_throttled(event, user_id, command, wait)
+                    return
+        try:
+            return await handler(event, data)
+        except RateLimited as error:
+            self.api_rejections += 1
+            logger.warning(f'ID{user_id} -- {error}')
+            await self.reply_throttled(event, user_id, None, error.retry_after)
+
+    async def reply_throttled(self, message, user_id, command, wait):
+        chart_key = chart_keys.get(user_id) if command == "progress_graphs" else None
+        file_id = chart_cache.get(chart_key) if chart_key is not None else None
+        if file_id is not None:
+            self.cached_replies += 1
+            await message.answer_photo(file_id, caption="📊 Ваш прогресс по воде и калориям")
+            return
+        now = time.monotonic()
+        if self.notified.get(user_id, 0) > now:
+            return
+        if len(self.notified) > self.limiter.max_size:
+            self.notified = {user: until for user, until in self.notified.items() if until > now}
+        self.notified[user_id] = now + wait
+        seconds = max(round(wait), 1)
+        await message.answer(f"⏳ Слишком много запросов. Попробуйте через {seconds} "
+                             f"{get_declension(seconds, ['секунду', 'секунды', 'секунд'])}.")
+
+
+rate_limit_middleware = RateLimitMiddleware(parse_rate_limits(RATE_LIMITS))
+router.message.outer_middleware(rate_limit_middleware)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        labels = (("handler", data["handler"].callback.__name__),)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as error:
+            metrics.inc("bot_handler_errors_total", labels + (("error", type(error).__name__),))
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - started)
+
+
+router.message.middleware(HandlerMetricsMiddleware())
 
 
 @router.message(Command("start"))
 async def start_command(message: Message):
     user_id = message.from_user.id
-    if user_id not in users:
+    user = get_user(user_id)
+    if user is None:
         logger.info(f'ID{user_id} -- Bot started!')
         await message.answer("Привет! Я помогу рассчитать дневные нормы воды и калорий!\n"
                              "Напиши /set_profile, чтобы начать.")
         return
 
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    user = users[user_id]
     await message.answer("Привет! Я помогу рассчитать дневные нормы воды и калорий!\n\n"
                          f"📊 **Ваш профиль**\n"
-                         f"Вес: {user['weight']} кг\n"
-                         f"Рост: {user['height']} см\n"
-                         f"Возраст: {user['age']} {get_declension(user['age'], ['год', 'года', 'лет'])}\n"
-                         f"Активность: {user['activity']} мин/день\n"
-                         f"Город: {user['city']}\n"
-                         f"Пол: {'Мужской' if user['gender'] == 'м' else 'Женский'}\n" +
-                         (f"Цель калорий: {user['calorie_goal']} ккал/день"
-                          if 'calorie_goal' in user else ''),
+                         f"Вес: {user.weight} кг\n"
+                         f"Рост: {user.height} см\n"
+                         f"Возраст: {user.age} {get_declension(user.age, ['год', 'года', 'лет'])}\n"
+                         f"Активность: {user.activity} мин/день\n"
+                         f"Город: {user.city}\n"
+                         f"Пол: {'Мужской' if user.gender == 'м' else 'Женский'}\n"
+                         f"Цель калорий: {user.calorie_goal} ккал/день",
                          parse_mode="Markdown")
 
 
@@ -240,8 +1500,8 @@ async def set_profile(message: Message, state: FSMContext):
 @router.message(UserProfile.weight)
 async def process_weight(message: Message, state: FSMContext):
     weight = message.text
-    if not weight.isdigit() or int(weight) <= 0:
-        await message.answer("Вес должен быть натуральным числом. Попробуйте снова.")
+    if not weight.isdigit() or not 0 < int(weight) <= 500:
+        await message.answer("Вес должен быть натуральным числом не больше 500. Попробуйте снова.")
         return
     await state.update_data(weight=int(weight))
     await message.answer("Введите ваш рост (в см):")
@@ -251,8 +1511,8 @@ async def process_weight(message: Message, state: FSMContext):
 @router.message(UserProfile.height)
 async def process_height(message: Message, state: FSMContext):
     height = message.text
-    if not height.isdigit() or int(height) <= 0:
-        await message.answer("Рост должен быть натуральным числом. Попробуйте снова.")
+    if not height.isdigit() or not 0 < int(height) <= 300:
+        await message.answer("Рост должен быть натуральным числом не больше 300. Попробуйте снова.")
         return
     await state.update_data(height=int(height))
     await message.answer("Введите ваш возраст:")
@@ -262,8 +1522,8 @@ async def process_height(message: Message, state: FSMContext):
 @router.message(UserProfile.age)
 async def process_age(message: Message, state: FSMContext):
     age = message.text
-    if not age.isdigit() or int(age) <= 0:
-        await message.answer("Возраст должен быть натуральным числом. Попробуйте снова.")
+    if not age.isdigit() or not 0 < int(age) <= 150:
+        await message.answer("Возраст должен быть натуральным числом не больше 150. Попробуйте снова.")
         return
     await state.update_data(age=int(age))
     await message.answer("Сколько минут активности у вас в день?")
@@ -273,8 +1533,8 @@ async def process_age(message: Message, state: FSMContext):
 @router.message(UserProfile.activity)
 async def process_activity(message: Message, state: FSMContext):
     activity = message.text
-    if not activity.isdigit() or int(activity) < 0:
-        await message.answer("Активность должна быть целым неотрицательным числом. Попробуйте снова.")
+    if not activity.isdigit() or int(activity) > 1440:
+        await message.answer("Активность должна быть целым неотрицательным числом не больше 1440. Попробуйте снова.")
         return
     await state.update_data(activity=int(activity))
     await message.answer("В каком городе вы находитесь?")
@@ -284,11 +1544,12 @@ async def process_activity(message: Message, state: FSMContext):
 @router.message(UserProfile.city)
 async def process_city(message: Message, state: FSMContext):
     city = message.text
-    geo = get_geolocation(city, OPEN_WEATHER_API_KEY)
+    geo = await get_city_geolocation(city)
     if 'error' in geo:
         await message.answer('Ошибка при поиске города: ' + geo['error'])
         return
     await state.update_data(city=city)
+    run_in_background(load_city_weather(city))
     await message.answer("Какой у вас пол? (м/ж)")
     await state.set_state(UserProfile.gender)
 
@@ -323,19 +1584,23 @@ async def process_calorie_goal(message: Message, state: FSMContext):
     gender = user_data["gender"]
 
     if message.text == "Рассчитывать автоматически":
-        if gender == "м":
-            calorie_goal = int(10 * weight + 6.25 * height - 5 * age + 5)
-        else:
-            calorie_goal = int(10 * weight + 6.25 * height - 5 * age - 161)
+        calorie_goal = calculate_calorie_goal(weight, height, age, gender)
     else:
-        if not message.text.isdigit() or int(message.text) <= 0:
-            await message.answer("Цель калорий должна быть натуральным числом. Попробуйте снова.")
+        if not message.text.isdigit() or not 0 < int(message.text) <= 20000:
+            await message.answer("Цель калорий должна быть натуральным числом не больше 20000. Попробуйте снова.")
             return
         calorie_goal = int(message.text)
 
     await state.update_data(calorie_goal=calorie_goal)
+    weather = city_weather.get(" ".join(city.casefold().split()))
+    user = UserRecord(weight, height, age, activity, city, gender, calorie_goal,
+                      weather["utc_offset"] if weather else 0)
+    user.day = local_day(user)
     user_id = message.from_user.id
-    users[user_id] = user_data
+    users[user_id] = user
+    user_storage.save_user(user_id)
+    invalidate_chart(user_id)
+    reminder_scheduler.schedule(user_id, user)
 
     await state.clear()
     await message.answer(f"_Ваш профиль сохранен!_\n\n"
@@ -354,41 +1619,30 @@ async def process_calorie_goal(message: Message, state: FSMContext):
 async def log_water(message: Message):
     user_id = message.from_user.id
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    if user_id not in users:
+    user = get_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
         return
 
     args = message.text.split()
-    if len(args) != 2 or not args[1].isdigit() or int(args[1]) <= 0:
-        await message.answer("Используйте формат: /log_water <количество мл (натуральное)>. "
+    if len(args) != 2 or not args[1].isdigit() or not 0 < int(args[1]) <= 10000:
+        await message.answer("Используйте формат: /log_water <количество мл (натуральное, до 10000)>. "
                              "Пример: /log_water 250")
         return
 
     volume = int(args[1])
-    users[user_id]["logged_water"] = users[user_id].get("logged_water", 0) + volume
+    user.logged_water += volume
+    event_log.append(user_id, EVENT_WATER, volume)
+    user_storage.save_user(user_id)
+    invalidate_chart(user_id)
 
-    user = users[user_id]
-    weight = user["weight"]
-    activity = user["activity"]
-    city = user["city"]
-
-    geo = get_geolocation(city, OPEN_WEATHER_API_KEY)
-    if 'error' in geo:
+    temp = await get_user_temp(user_id, user)
+    if temp is None:
         await message.answer("Не удалось определить погоду. Цель по воде рассчитана без учета температуры.")
         temp = 20
-    else:
-        temp = get_current_temp(geo['lat'], geo['lon'], OPEN_WEATHER_API_KEY)
-        if temp is None:
-            await message.answer("Не удалось определить погоду. Цель по воде рассчитана без учета температуры.")
-            temp = 20
-
-    water_goal = (user.get("additional_water_goal", 0) +
-                  weight * 30 + (500 * (activity // 30)))
-    if temp > 25:
-        water_goal += 500
-    if temp > 30:
-        water_goal += 1000
-    remaining = max(water_goal - user["logged_water"], 0)
+
+    water_goal = get_water_goal(user, temp)
+    remaining = max(water_goal - user.logged_water, 0)
 
     await message.answer(f"💧 Записано: {volume} мл воды.\n"
                          f"Норма воды: {water_goal} мл (с учетом активности и температуры {temp}°C).\n"
@@ -399,7 +1653,7 @@ async def log_water(message: Message):
 async def log_food(message: Message, state: FSMContext):
     user_id = message.from_user.id
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    if user_id not in users:
+    if get_user(user_id) is None:
         await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
         return
 
@@ -410,24 +1664,42 @@ async def log_food(message: Message, state: FSMContext):
         return
 
     product_name = args[1]
+    product_key = normalize_product_name(product_name)
 
-    calories_per_100g = extract_average_number(generate_text(
-        f'Сколько ккал на 100г в среднем содержится в продукте: "{product_name}". '
-        'Если нет точного ответа, оцени примерно. Отправь только значение числом - без пояснений и рассуждений. '
-        'Не пиши никаких других чисел в ответе.',
-        YANDEX_API_KEY,
-        YANDEX_CLOUD_CAT_ID,
-        temperature=0
-    ))
+    pending_reply = None
+    calories_per_100g = nutrition_index.lookup(product_name)
     if calories_per_100g is None:
-        await message.answer("Калорийность продукта не найдена.")
-        return
+        cached = product_key in food_cache
+        lookup = asyncio.ensure_future(food_cache.get_or_fetch(
+            product_key, lambda: calorie_batcher.estimate(product_key, product_name)))
+        if not cached:
+            try:
+                pending_reply = await message.answer(f"🔎 Оцениваю калорийность: _{product_name}_...",
+                                                     parse_mode="Markdown")
+            except BaseException:
+                lookup.cancel()
+                raise
+        try:
+            calories_per_100g = await lookup
+        except Exception:
+            if pending_reply is not None:
+                try:
+                    await pending_reply.edit_text("Не удалось оценить калорийность продукта.")
+                except TelegramAPIError as error:
+                    logger.warning(f'ID{user_id} -- Failed to update the pending reply: {error}')
+            raise
 
-    await state.update_data(food_name=product_name, food_calories=calories_per_100g)
-    await message.answer(f"🍽 _{product_name}_: ~{calories_per_100g} ккал на 100 г.\n"
-                         f"Сколько грамм вы съели/выпили?",
-                         parse_mode="Markdown")
-    await state.set_state("waiting_food_weight")
+    if calories_per_100g is None:
+        text = "Калорийность продукта не найдена."
+    else:
+        await state.update_data(food_name=product_name, food_calories=calories_per_100g)
+        await state.set_state("waiting_food_weight")
+        text = (f"🍽 _{product_name}_: ~{calories_per_100g} ккал на 100 г.\n"
+                f"Сколько грамм вы съели/выпили?")
+    if pending_reply is not None:
+        await pending_reply.edit_text(text, parse_mode="Markdown")
+    else:
+        await message.answer(text, parse_mode="Markdown")
 
 
 @router.message(StateFilter("waiting_food_weight"))
@@ -441,7 +1713,11 @@ async def process_food_weight(message: Message, state: FSMContext):
     grams = int(message.text)
     calories = (grams / 100) * data["food_calories"]
 
-    users[user_id]["logged_calories"] = users[user_id].get("logged_calories", 0) + calories
+    user = get_user(user_id)
+    user.logged_calories += calories
+    event_log.append(user_id, EVENT_FOOD, calories)
+    user_storage.save_user(user_id)
+    invalidate_chart(user_id)
     await state.clear()
     await message.answer(f"✅ Записано: {calories:.1f} ккал - _{data['food_name']}_.",
                          parse_mode="Markdown")
@@ -451,13 +1727,14 @@ async def process_food_weight(message: Message, state: FSMContext):
 async def log_workout(message: Message):
     user_id = message.from_user.id
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    if user_id not in users:
+    user = get_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
         return
 
     args = message.text.split(maxsplit=2)
-    if len(args) != 3 or not args[2].isdigit():
-        await message.answer("Используйте формат: /log_workout <тип тренировки> <время в минутах>.\n"
+    if len(args) != 3 or not args[2].isdigit() or int(args[2]) > 1440:
+        await message.answer("Используйте формат: /log_workout <тип тренировки> <время в минутах (до 1440)>.\n"
                              "Пример: /log_workout бег 30")
         return
 
@@ -476,8 +1753,11 @@ async def log_workout(message: Message):
     calories_burned = workout_calories[workout_type] * minutes
     water_needed = (minutes // 30) * 200
 
-    users[user_id]["burned_calories"] = users[user_id].get("burned_calories", 0) + calories_burned
-    users[user_id]["additional_water_goal"] = users[user_id].get("additional_water_goal", 0) + water_needed
+    user.burned_calories += calories_burned
+    user.additional_water_goal += water_needed
+    event_log.append(user_id, EVENT_WORKOUT, calories_burned)
+    user_storage.save_user(user_id)
+    invalidate_chart(user_id)
 
     await message.answer(f"🏋️‍♂️ {workout_type.capitalize()} {minutes} мин — {calories_burned} ккал сожжено.\n" +
                          (f"*Дополнительно:* выпейте {water_needed} мл воды." if water_needed > 0 else ""),
@@ -488,38 +1768,23 @@ async def log_workout(message: Message):
 async def check_progress(message: Message):
     user_id = message.from_user.id
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    if user_id not in users:
+    user = get_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
         return
 
-    user = users[user_id]
-    weight = user["weight"]
-    activity = user["activity"]
-    city = user["city"]
-    logged_water = user.get("logged_water", 0)
-    logged_calories = user.get("logged_calories", 0)
-    burned_calories = user.get("burned_calories", 0)
+    logged_water = user.logged_water
+    logged_calories = user.logged_calories
+    burned_calories = user.burned_calories
 
-    geo = get_geolocation(city, OPEN_WEATHER_API_KEY)
-    if 'error' in geo:
+    temp = await get_user_temp(user_id, user)
+    if temp is None:
         temp = 20
-    else:
-        temp = get_current_temp(geo["lat"], geo["lon"], OPEN_WEATHER_API_KEY) or 20
-
-    water_goal = (user.get("additional_water_goal", 0) +
-                  weight * 30 + (500 * (activity // 30)))
-    if temp > 25:
-        water_goal += 500
-    if temp > 30:
-        water_goal += 1000
+
+    water_goal = get_water_goal(user, temp)
     remaining_water = max(water_goal - logged_water, 0)
 
-    calorie_goal = user.get("calorie_goal", None)
-    if calorie_goal is None:
-        if user['gender'] == "м":
-            calorie_goal = int(10 * weight + 6.25 * user['height'] - 5 * user['age'] + 5)
-        else:
-            calorie_goal = int(10 * weight + 6.25 * user['height'] - 5 * user['age'] - 161)
+    calorie_goal = user.calorie_goal
     calorie_balance = logged_calories - burned_calories
 
     await message.answer(
@@ -539,17 +1804,442 @@ async def check_progress(message: Message):
 async def send_progress_graphs(message: Message):
     user_id = message.from_user.id
     logger.info(f'ID{user_id} -- Received: {message.text}')
-    if user_id not in users:
+    user = get_user(user_id)
+    if user is None:
+        await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
+        return
+
+    temp = get_cached_temp(user_id, user)
+    temp_task = asyncio.ensure_future(get_user_temp(user_id, user)) if temp is None else None
+    chart_inputs = get_progress_chart_inputs(user, 20 if temp is None else temp)
+    file_id, render_task = start_progress_render(chart_inputs)
+    if temp_task is not None:
+        try:
+            temp = await temp_task
+        except Exception:
+            if render_task is not None:
+                render_task.cancel()
+            raise
+        actual_inputs = get_progress_chart_inputs(user, 20 if temp is None else temp)
+        if actual_inputs != chart_inputs:
+            if render_task is not None:
+                render_task.cancel()
+            chart_inputs = actual_inputs
+            file_id, render_task = start_progress_render(chart_inputs)
+
+    if file_id is not None:
+        await message.answer_photo(file_id, caption="📊 Ваш прогресс по воде и калориям")
+        return
+
+    try:
+        png = await render_task
+    except RenderQueueFull:
+        logger.warning(f'ID{user_id} -- Render queue is full')
+        await message.answer("Сейчас строится слишком много графиков. Попробуйте через минуту.")
+        return
+    photo = BufferedInputFile(png, filename="progress.png")
+    sent = await message.answer_photo(photo, caption="📊 Ваш прогресс по воде и калориям")
+    chart_cache.set(chart_inputs, sent.photo[-1].file_id)
+    chart_keys[user_id] = chart_inputs
+
+
+def format_day(day):
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).strftime("%d.%m")
+
+
+@router.message(Command("history"))
+async def show_history(message: Message):
+    user_id = message.from_user.id
+    logger.info(f'ID{user_id} -- Received: {message.text}')
+    user = get_user(user_id)
+    if user is None:
+        await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
+        return
+
+    args = message.text.split()
+    if len(args) > 2 or (len(args) == 2 and (not args[1].isdigit() or not 1 <= int(args[1]) <= 90)):
+        await message.answer("Используйте формат: /history <количество дней от 1 до 90>. Пример: /history 7")
+        return
+
+    days = int(args[1]) if len(args) == 2 else 7
+    first_day, totals = event_log.daily_totals(user_id, days, user.utc_offset)
+    lines = [f"📅 *История за {days} {get_declension(days, ['день', 'дня', 'дней'])}:*"]
+    for offset in np.flatnonzero(totals.any(axis=0)).tolist():
+        water, calories_in, calories_burned = totals[:, offset]
+        lines.append(f"{format_day(first_day + offset)}: 💧 {water:.0f} мл, "
+                     f"🍽 {calories_in:.0f} ккал, 🔥 {calories_burned:.0f} ккал")
+    if len(lines) == 1:
+        lines.append("Записей пока нет.")
+    else:
+        water, calories_in, calories_burned = totals.mean(axis=1)
+        lines.append(f"\n*В среднем за день:* 💧 {water:.0f} мл, 🍽 {calories_in:.0f} ккал, "
+                     f"🔥 {calories_burned:.0f} ккал")
+    await message.answer("\n".join(lines), parse_mode="Markdown")
+
+
+@router.message(Command("weekly_graphs"))
+async def send_weekly_graphs(message: Message):
+    user_id = message.from_user.id
+    logger.info(f'ID{user_id} -- Received: {message.text}')
+    user = get_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
         return
 
-    graph_path = plot_progress(user_id)
-    photo = FSInputFile(graph_path)
-    await message.answer_photo(photo, caption="📊 Ваш прогресс по воде и калориям")
+    first_day, totals = event_log.daily_totals(user_id, 7, user.utc_offset)
+    labels = [format_day(first_day + offset) for offset in range(7)]
+    try:
+        png = await render_in_pool("render_weekly_png", labels, *totals.tolist())
+    except RenderQueueFull:
+        logger.warning(f'ID{user_id} -- Render queue is full')
+        await message.answer("Сейчас строится слишком много графиков. Попробуйте через минуту.")
+        return
+    photo = BufferedInputFile(png, filename="weekly.png")
+    await message.answer_photo(photo, caption="📊 Ваша статистика за неделю")
+
+
+@router.message(Command("report"))
+async def send_report(message: Message):
+    user_id = message.from_user.id
+    logger.info(f'ID{user_id} -- Received: {message.text}')
+    user = get_user(user_id)
+    if user is None:
+        await message.answer("Сначала настройте профиль с помощью команды /set_profile.")
+        return
+
+    args = message.text.split()
+    if len(args) > 2 or (len(args) == 2 and (not args[1].isdigit() or int(args[1]) not in REPORT_PERIODS)):
+        await message.answer("Используйте формат: /report <7, 30 или 90>. Пример: /report 30")
+        return
+
+    days = int(args[1]) if len(args) == 2 else 7
+    first_day, totals = event_log.daily_totals(user_id, days, user.utc_offset)
+    active_days = int(totals.any(axis=0).sum())
+    if not active_days:
+        await message.answer(f"За последние {days} {get_declension(days, ['день', 'дня', 'дней'])} записей пока нет.")
+        return
+
+    labels = [format_day(first_day + offset) for offset in range(days)]
+    try:
+        png = await render_in_pool("render_report_png", labels, *totals.tolist(), user.base_water_goal,
+                                   user.calorie_goal, 7 if days > 7 else 0)
+    except RenderQueueFull:
+        logger.warning(f'ID{user_id} -- Render queue is full')
+        await message.answer("Сейчас строится слишком много графиков. Попробуйте через минуту.")
+        return
+
+    water, calories_in, calories_burned = totals.mean(axis=1)
+    goal_days = int((totals[0] >= user.base_water_goal).sum())
+    caption = (f"📈 Отчет за {days} {get_declension(days, ['день', 'дня', 'дней'])}, "
+               f"дней с записями: {active_days}\n"
+               f"💧 В среднем {water:.0f} мл в день, норма выполнена "
+               f"{goal_days} {get_declension(goal_days, ['день', 'дня', 'дней'])}\n"
+               f"🍽 {calories_in:.0f} ккал и 🔥 {calories_burned:.0f} ккал в среднем за день")
+    await message.answer_photo(BufferedInputFile(png, filename=f"report_{days}.png"), caption=caption)
+
+
+@router.message(Command("export_weekly"))
+async def export_weekly_summaries(message: Message):
+    user_id = message.from_user.id
+    logger.info(f'ID{user_id} -- Received: {message.text}')
+    if user_id not in ADMIN_IDS:
+        return
+
+    offsets = user_storage.load_utc_offsets() if WORKERS > 1 else {user_id: user.utc_offset
+                                                                    for user_id, user in users.items()}
+    user_ids, first_days, totals = event_log.bulk_daily_totals(list(offsets), list(offsets.values()), 7,
+                                                               await event_log.load_all())
+    active = totals.any(axis=(1, 2))
+    user_ids, first_days, totals = user_ids[active], first_days[active], totals[active]
+    if not len(user_ids):
+        await message.answer("За последнюю неделю записей нет.")
+        return
+
+    sheet_size = WEEKLY_SHEET_GRID[0] * WEEKLY_SHEET_GRID[1]
+    group_size = sheet_size * WEEKLY_SHEETS_PER_MESSAGE
+    sheets_total = -(-len(user_ids) // sheet_size)
+    await message.answer(f"Формирую недельные сводки: {len(user_ids)} "
+                         f"{get_declension(len(user_ids), ['пользователь', 'пользователя', 'пользователей'])}, "
+                         f"{sheets_total} {get_declension(sheets_total, ['лист', 'листа', 'листов'])}.")
+
+    def render_group(start):
+        labels = [[format_day(first_day + offset) for offset in range(7)]
+                  for first_day in first_days[start:start + group_size].tolist()]
+        return asyncio.ensure_future(render_in_pool("render_weekly_sheets", WEEKLY_SHEET_GRID,
+                                                    user_ids[start:start + group_size].tolist(), labels,
+                                                    totals[start:start + group_size]))
+
+    starts = range(0, len(user_ids), group_size)
+    next_group = render_group(0)
+    for start in starts:
+        try:
+            sheets = await next_group
+        except RenderQueueFull:
+            await message.answer("Сейчас строится слишком много графиков. Попробуйте через минуту.")
+            return
+        if start + group_size < len(user_ids):
+            next_group = render_group(start + group_size)
+        documents = [BufferedInputFile(png, filename=f"weekly_{(start + index * sheet_size) // sheet_size + 1}.png")
+                     for index, png in enumerate(sheets)]
+        if len(documents) == 1:
+            await message.answer_document(documents[0])
+        else:
+            await message.answer_media_group([InputMediaDocument(media=document) for document in documents])
+
+
+@router.message(Command("stats"))
+async def show_stats(message: Message):
+    user_id = message.from_user.id
+    logger.info(f'ID{user_id} -- Received: {message.text}')
+    if user_id not in ADMIN_IDS:
+        return
+
+    lines = ["📈 *Кэши*"]
+    for name, cache in [("Геокодинг", geo_cache), ("Погода", weather_cache), ("Калорийность", food_cache),
+                        ("Графики", chart_cache)]:
+        stats = cache.stats()
+        lines.append(f"*{name}:* {stats['hit_rate']:.0%} попаданий "
+                     f"({stats['hits']}/{stats['hits'] + stats['misses']}), "
+                     f"объединено: {stats['coalesced']}, вытеснено: {stats['evictions']}, "
+                     f"записей: {stats['size']}")
+    lines.append(f"\n🥫 *База продуктов:* найдено: {nutrition_index.hits}, "
+                 f"не найдено: {nutrition_index.misses}")
+    lines.append(f"🤖 *YandexGPT:* пакетов: {calorie_batcher.batches}, "
+                 f"продуктов в пакетах: {calorie_batcher.batched_items}, "
+                 f"одиночных повторов: {calorie_batcher.fallbacks}")
+    lines.append(f"⏰ *Напоминания:* отправлено: {reminder_scheduler.sent}, "
+                 f"не понадобилось: {reminder_scheduler.skipped}, ошибок: {reminder_scheduler.failed}, "
+                 f"в очереди: {len(reminder_scheduler.due)}")
+
+    lines.append("\n🚦 *Ограничения запросов* (пропущено/отклонено)")
+    for name, (allowed, throttled) in (rate_limit_middleware.limiter.stats() | api_limiter.stats()).items():
+        lines.append(f"`{name}`: {allowed}/{throttled}")
+    lines.append(f"Ответов из кэша: {rate_limit_middleware.cached_replies}, "
+                 f"отказов внешних API: {rate_limit_middleware.api_rejections}")
+    await message.answer("\n".join(lines), parse_mode="Markdown")
+
+
+def create_bot():
+    return Bot(token=BOT_TOKEN,
+               session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None)
+
+
+def create_front_app():
+    global bot, dispatcher
+    if dispatcher is not None:
+        return bot, dispatcher
+    if not BOT_TOKEN:
+        raise ValueError("Check environment variables")
+    bot = create_bot()
+    dispatcher = Dispatcher(disable_fsm=True)
+    return bot, dispatcher
+
+
+def create_app():
+    global food_cache, user_storage, users, event_log, bot, dispatcher
+    if dispatcher is not None:
+        return bot, dispatcher
+    if not all([YANDEX_CLOUD_CAT_ID, YANDEX_KEY_ID, YANDEX_API_KEY, OPEN_WEATHER_API_KEY, BOT_TOKEN]):
+        raise ValueError("Check environment variables")
+
+    food_cache = FoodCalorieCache(FOOD_CACHE_SIZE, DB_PATH)
+    user_storage = create_user_storage()
+    users = user_storage.load_users() if WORKERS == 1 else user_storage.users
+    event_log = EventLog(EVENT_LOG_PATH if STORAGE != "memory" else None, DB_FLUSH_INTERVAL, shard_index, WORKERS)
+
+    bot = create_bot()
+    bot.session.middleware(observe_telegram_request)
+    dispatcher = Dispatcher(storage=user_storage.fsm)
+    dispatcher.include_router(router)
+
+    dispatcher.startup.register(user_storage.start)
+    dispatcher.startup.register(event_log.start)
+    dispatcher.startup.register(start_weather_refresh)
+    dispatcher.startup.register(start_metrics_server)
+    dispatcher.startup.register(reminder_scheduler.start)
+    dispatcher.shutdown.register(stop_metrics_server)
+    dispatcher.shutdown.register(stop_weather_refresh)
+    dispatcher.shutdown.register(reminder_scheduler.stop)
+    dispatcher.shutdown.register(close_http_session)
+    dispatcher.shutdown.register(food_cache.close)
+    dispatcher.shutdown.register(user_storage.close)
+    dispatcher.shutdown.register(event_log.close)
+    dispatcher.shutdown.register(close_render_pool)
+    return bot, dispatcher
+
+
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+webhook_closing = False
+metrics.gauge(collect_runtime_metrics)
+
+
+async def handle_webhook(request):
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+                                                  WEBHOOK_SECRET.encode()):
+        return web.Response(status=401)
+    if webhook_closing:
+        return web.Response(status=503)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except ValueError:
+        return web.Response(status=400)
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        logger.warning(f'Update queue is full, rejecting update {update.update_id}')
+        return web.Response(status=503)
+    return web.Response()
+
+
+async def process_updates():
+    while True:
+        update = await update_queue.get()
+        try:
+            await dispatcher.feed_update(bot, update)
+        except Exception:
+            logger.exception(f'Failed to process update {update.update_id}')
+        finally:
+            update_queue.task_done()
+
+
+async def run_webhook():
+    global webhook_closing
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+    workers = [asyncio.create_task(process_updates()) for _ in range(UPDATE_WORKERS if WORKERS == 1 else 1)]
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=router.resolve_used_update_types())
+    logger.info(f'Listening for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}')
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info(f'Shutting down, {update_queue.qsize()} updates left in queue')
+    webhook_closing = True
+    try:
+        await asyncio.wait_for(update_queue.join(), timeout=30)
+    except asyncio.TimeoutError:
+        logger.warning(f'Dropped {update_queue.qsize()} unprocessed updates')
+    for worker in workers:
+        worker.cancel()
+    await runner.cleanup()
+    await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+    await bot.session.close()
+
+
+class ShardRouter(BaseMiddleware):
+    def __init__(self, queues):
+        self.queues = queues
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event.event, "from_user", None)
+        shard_queue = self.queues[(user.id if user else 0) % len(self.queues)]
+        payload = event.model_dump_json(exclude_unset=True)
+        try:
+            shard_queue.put_nowait(payload)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, shard_queue.put, payload)
+
+
+class UserOrderedRunner:
+    def __init__(self, concurrency):
+        self.pending = {}
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def submit(self, user_id, update):
+        updates = self.pending.get(user_id)
+        if updates is not None:
+            updates.append(update)
+            return
+        self.pending[user_id] = deque([update])
+        task = asyncio.create_task(self.drain(user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self, user_id):
+        updates = self.pending[user_id]
+        while updates:
+            update = updates.popleft()
+            async with self.semaphore:
+                try:
+                    await dispatcher.feed_update(bot, update)
+                except Exception:
+                    logger.exception(f'Failed to process update {update.update_id}')
+        del self.pending[user_id]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+async def serve_shard(index, shard_queue):
+    global shard_index
+    shard_index = index
+    create_app()
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+    logger.info(f'Shard {index} started')
+    loop = asyncio.get_running_loop()
+    runner = UserOrderedRunner(UPDATE_WORKERS)
+    while True:
+        payload = await loop.run_in_executor(None, shard_queue.get)
+        if payload is None:
+            break
+        update = Update.model_validate_json(payload, context={"bot": bot})
+        user = getattr(update.event, "from_user", None)
+        runner.submit(user.id if user else 0, update)
+    await runner.join()
+    await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+    await bot.session.close()
+    logger.info(f'Shard {index} stopped')
+
+
+def run_shard_worker(index, shard_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(index, shard_queue))
+
+
+async def run_sharded():
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(WORKERS)]
+    processes = [context.Process(target=run_shard_worker, args=(index, shard_queue), name=f"shard-{index}")
+                 for index, shard_queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+    dispatcher.update.outer_middleware(ShardRouter(queues))
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dispatcher.start_polling(bot, handle_as_tasks=False,
+                                           allowed_updates=router.resolve_used_update_types())
+    finally:
+        for shard_queue in queues:
+            shard_queue.put(None)
+        for process in processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join)
 
 
 async def main():
-    await dispatcher.start_polling(bot)
+    if BOT_MODE not in ("polling", "webhook"):
+        raise ValueError(f"Unknown bot mode: {BOT_MODE}")
+    if WORKERS > 1:
+        create_front_app()
+        await run_sharded()
+        return
+    create_app()
+    if BOT_MODE == "webhook":
+        await run_webhook()
+    else:
+        await dispatcher.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+import os
+import re
+import sys
+import csv
+import gzip
+import json
+import zlib
+import logging
+import argparse
+from array import array
+import numpy as np
+
+
+MIN_KCAL = 0
+MAX_KCAL = 900
+MAX_NAME_LENGTH = 100
+MAX_POSTINGS = 100000
+NAME_FIELDS = ("product_name_ru", "product_name", "product_name_en", "generic_name_ru", "generic_name")
+
+RUSSIAN_ENDINGS = sorted(["иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими",
+                          "ов", "ев", "ей", "ой", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие",
+                          "ом", "ем", "ам", "ям", "ах", "ях", "ую", "юю",
+                          "а", "я", "ы", "и", "у", "ю", "е", "о"], key=len, reverse=True)
+
+logger = logging.getLogger(__name__)
+
+
+def stem_word(word):
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize_product_name(name):
+    words = re.findall(r"\w+", name.casefold().replace("ё", "е"))
+    return " ".join(stem_word(word) for word in words) or " ".join(name.casefold().split())
+
+
+def get_trigrams(name):
+    padded = f"  {name} "
+    return sorted({zlib.crc32(padded[i:i + 3].encode()) for i in range(len(padded) - 2)})
+
+
+class NutritionIndex:
+    def __init__(self, path, threshold=0.6):
+        self.path = path
+        self.threshold = threshold
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        self.loaded = True
+        if not os.path.isdir(self.path):
+            logger.warning(f'Nutrition index not found at "{self.path}", using YandexGPT only')
+            self.kcal = None
+            return
+        arrays = {name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+                  for name in ("kcal", "name_offsets", "names", "trigram_counts", "trigram_keys",
+                               "trigram_offsets", "postings")}
+        self.__dict__.update(arrays)
+        logger.info(f'Loaded nutrition index with {len(self.kcal)} products from "{self.path}"')
+
+    def get_name(self, row):
+        return bytes(self.names[self.name_offsets[row]:self.name_offsets[row + 1]]).decode()
+
+    def lookup(self, product_name):
+        if not self.loaded:
+            self.load()
+        match = self.search(normalize_product_name(product_name)) if self.kcal is not None else None
+        if match is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Matched "{product_name}" to "{self.get_name(match)}" in the nutrition index')
+        return int(round(float(self.kcal[match])))
+
+    def search(self, name):
+        trigrams = np.array(get_trigrams(name), dtype=np.uint32)
+        positions = np.minimum(np.searchsorted(self.trigram_keys, trigrams), len(self.trigram_keys) - 1)
+        positions = positions[self.trigram_keys[positions] == trigrams]
+        if not len(positions):
+            return None
+
+        starts = self.trigram_offsets[positions]
+        ends = self.trigram_offsets[positions + 1]
+        selective = ends - starts <= MAX_POSTINGS
+        if selective.any():
+            starts, ends = starts[selective], ends[selective]
+        candidates = np.concatenate([self.postings[start:end] for start, end in zip(starts, ends)])
+        rows, common = np.unique(candidates, return_counts=True)
+        scores = common / (len(trigrams) + self.trigram_counts[rows].astype(np.int64) - common)
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        return int(rows[best])
+
+
+def open_dump(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    stream = opener(path, "rt", encoding="utf-8", newline="")
+    if ".jsonl" in path or ".json" in path:
+        return (json.loads(line) for line in stream if line.strip())
+    csv.field_size_limit(sys.maxsize)
+    return csv.DictReader(stream, delimiter="\t")
+
+
+def iter_products(path):
+    if path is None:
+        from openfoodfacts import ProductDataset
+        return iter(ProductDataset(dataset_type="csv"))
+    return open_dump(path)
+
+
+def get_kcal(product):
+    nutriments = product.get("nutriments") or product
+    for key, factor in (("energy-kcal_100g", 1), ("energy_100g", 1 / 4.184)):
+        try:
+            kcal = float(nutriments.get(key) or "nan") * factor
+        except (TypeError, ValueError):
+            continue
+        if MIN_KCAL < kcal <= MAX_KCAL:
+            return kcal
+    return None
+
+
+def build_index(products, path):
+    values = {}
+    for count, product in enumerate(products, start=1):
+        kcal = get_kcal(product)
+        if kcal is not None:
+            names = {normalize_product_name(product[field]) for field in NAME_FIELDS
+                     if isinstance(product.get(field), str) and 0 < len(product[field]) <= MAX_NAME_LENGTH}
+            for name in names:
+                values.setdefault(name, array("f")).append(kcal)
+        if count % 100000 == 0:
+            logger.info(f"Read {count} products, {len(values)} distinct names")
+
+    names = sorted(values)
+    kcal = np.array([np.median(values[name]) for name in names], dtype=np.float32)
+    encoded = [name.encode() for name in names]
+    name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+
+    trigram_keys, trigram_rows = array("I"), array("i")
+    trigram_counts = np.zeros(len(names), dtype=np.uint16)
+    for row, name in enumerate(names):
+        trigrams = get_trigrams(name)
+        trigram_counts[row] = len(trigrams)
+        trigram_keys.extend(trigrams)
+        trigram_rows.extend([row] * len(trigrams))
+    trigram_keys = np.frombuffer(trigram_keys, dtype=np.uint32)
+    order = np.argsort(trigram_keys, kind="stable")
+    sorted_keys = trigram_keys[order]
+    unique_keys, starts = np.unique(sorted_keys, return_index=True)
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        "kcal": kcal,
+        "name_offsets": name_offsets,
+        "names": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "trigram_counts": trigram_counts,
+        "trigram_keys": unique_keys,
+        "trigram_offsets": np.append(starts, len(sorted_keys)).astype(np.int64),
+        "postings": np.frombuffer(trigram_rows, dtype=np.int32)[order]
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+    logger.info(f'Saved nutrition index with {len(names)} products to "{path}"')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the offline nutrition index from an Open Food Facts dump")
+    parser.add_argument("dump", nargs="?",
+                        help="Open Food Facts CSV/TSV or JSONL dump, optionally gzipped. "
+                             "Downloaded with the openfoodfacts package when omitted")
+    parser.add_argument("--output", default=os.getenv("NUTRITION_INDEX_PATH", "nutrition_index"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s",
+                        datefmt="%b %d %I:%M:%S %p")
+    build_index(iter_products(args.dump), args.output)
+
+
+if __name__ == "__main__":
+    main()